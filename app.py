@@ -6,6 +6,7 @@ Point d'entrée Streamlit — Page d'accueil + initialisation RAG
 import streamlit as st
 import os
 from graph.state import PatientState
+from rag.store import get_status, get_error, init_vectorstore
 
 st.set_page_config(
     page_title="UtopIA — Préconisation VPH",
@@ -122,10 +123,6 @@ h1, h2, h3 { font-family: 'DM Serif Display', serif; }
 # ── Initialisation session ────────────────────────────────────────────────────
 if "patient" not in st.session_state:
     st.session_state.patient = PatientState()
-if "vectorstore" not in st.session_state:
-    st.session_state.vectorstore = None
-if "rag_status" not in st.session_state:
-    st.session_state.rag_status = "idle"
 
 
 # ── Sidebar ───────────────────────────────────────────────────────────────────
@@ -155,9 +152,9 @@ with st.sidebar:
 
     st.divider()
 
-    # RAG Status
+    # RAG Status — vectorstore unique partagé par toutes les sessions
     st.markdown("**📚 Base de connaissances RAG**")
-    rag_status = st.session_state.rag_status
+    rag_status = get_status()
 
     if rag_status == "ready":
         st.markdown('<div class="rag-ready">✅ Base vectorielle chargée</div>', unsafe_allow_html=True)
@@ -165,6 +162,8 @@ with st.sidebar:
         st.markdown('<div class="rag-loading">⏳ Chargement en cours...</div>', unsafe_allow_html=True)
     elif rag_status == "error":
         st.markdown('<div class="rag-error">❌ Erreur de chargement</div>', unsafe_allow_html=True)
+        if get_error():
+            st.caption(get_error())
     else:
         st.markdown('<div class="rag-loading">⚡ Non initialisée</div>', unsafe_allow_html=True)
 
@@ -175,14 +174,9 @@ with st.sidebar:
         else:
             with st.spinner("Vectorisation des documents..."):
                 try:
-                    st.session_state.rag_status = "loading"
-                    from rag.ingest import build_vectorstore
-                    vs = build_vectorstore(api_key)
-                    st.session_state.vectorstore = vs
-                    st.session_state.rag_status = "ready"
+                    init_vectorstore(api_key)
                     st.rerun()
                 except Exception as e:
-                    st.session_state.rag_status = "error"
                     st.error(f"Erreur : {e}")
 
     st.divider()
@@ -208,7 +202,7 @@ with st.sidebar:
         st.divider()
         if st.button("🗑️ Réinitialiser le patient", use_container_width=True):
             st.session_state.patient = PatientState()
-            for k in ["obs_par_vph", "axes_evaluation"]:
+            for k in ["obs_par_vph", "axes_evaluation", "preconisation_cache"]:
                 if k in st.session_state:
                     del st.session_state[k]
             st.rerun()
@@ -232,7 +226,7 @@ st.markdown("""
 
 # ── Guide de démarrage ────────────────────────────────────────────────────────
 patient = st.session_state.patient
-if not st.session_state.get("api_key") or st.session_state.rag_status != "ready":
+if not st.session_state.get("api_key") or get_status() != "ready":
     st.markdown("## 🚀 Démarrage")
 
     col1, col2 = st.columns(2)
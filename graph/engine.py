@@ -0,0 +1,167 @@
+"""
+UtopIA — Moteur de graphe
+Petit exécuteur DAG au-dessus de PatientState : chaque node déclare les champs
+qu'il lit et ceux qu'il écrit, les nodes prêts tournent en parallèle et un node
+dont les entrées n'ont pas changé depuis sa dernière exécution est sauté.
+Aucune dépendance à Streamlit : utilisable en script ou en test.
+
+    report = PRECONISATION_GRAPH.run(patient, api_key, vectorstore, cache=cache)
+"""
+
+import hashlib
+import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from graph.state import PatientState
+
+# Champs lus par PatientState.to_context_summary() — entrée commune à presque tous les nodes
+PROFIL_FIELDS = (
+    "nom", "prenom", "age", "sexe", "diagnostic", "situation_sante",
+    "capacites_physiques", "lieu_vie", "activites", "deplacements",
+    "synthese_demande", "largeur_bassin", "poids",
+)
+
+
+@dataclass
+class Node:
+    """
+    `run(patient, api_key, vectorstore, refresh)` retourne un dict : les clés présentes dans
+    `outputs` sont écrites dans le PatientState, les autres sont conservées comme artefacts.
+    """
+    name: str
+    run: Callable[[PatientState, str, object, bool], dict]
+    inputs: Tuple[str, ...]
+    outputs: Tuple[str, ...]
+
+
+@dataclass
+class RunReport:
+    ran: List[str] = field(default_factory=list)
+    skipped: List[str] = field(default_factory=list)
+    durations: Dict[str, float] = field(default_factory=dict)
+    artifacts: Dict[str, dict] = field(default_factory=dict)
+
+
+def _fingerprint(node: Node, patient: PatientState) -> str:
+    values = {name: getattr(patient, name) for name in node.inputs}
+    raw = json.dumps([node.name, values], sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+class Graph:
+    def __init__(self, nodes: Iterable[Node]):
+        self.nodes: Dict[str, Node] = {}
+        for node in nodes:
+            if node.name in self.nodes:
+                raise ValueError(f"Node en double : {node.name}")
+            self.nodes[node.name] = node
+
+        producers = {}
+        for node in self.nodes.values():
+            for out in node.outputs:
+                if out in producers:
+                    raise ValueError(f"Champ {out} écrit par {producers[out]} et {node.name}")
+                producers[out] = node.name
+
+        # Un node dépend des producteurs des champs qu'il lit
+        self.upstream: Dict[str, set] = {
+            node.name: {producers[i] for i in node.inputs if i in producers and producers[i] != node.name}
+            for node in self.nodes.values()
+        }
+        self.order = self._toposort()
+
+    def _toposort(self) -> List[str]:
+        order, done, visiting = [], set(), set()
+
+        def visit(name: str) -> None:
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle détecté autour de {name}")
+            visiting.add(name)
+            for dep in sorted(self.upstream[name]):
+                visit(dep)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name)
+        return order
+
+    def run(
+        self,
+        patient: PatientState,
+        api_key: str,
+        vectorstore=None,
+        cache: Optional[dict] = None,
+        force: bool = False,
+        refresh: bool = False,
+        exclude: Iterable[str] = (),
+        max_workers: int = 4,
+        on_event: Optional[Callable[[str, str], None]] = None,
+    ) -> RunReport:
+        """
+        Exécute le graphe et met à jour `patient` en place.
+        `cache` (dict conservé par l'appelant entre deux exécutions) mémorise l'empreinte
+        des entrées de chaque node ; un node est sauté si son empreinte est inchangée et
+        ses sorties déjà renseignées. `force=True` ré-exécute tout ; `refresh=True` ré-exécute
+        tout en contournant aussi le cache des réponses LLM (cf. graph.memo).
+        `on_event(node, "start" | "done" | "skip")` permet de suivre l'avancement.
+        """
+        cache = cache if cache is not None else {}
+        notify = on_event or (lambda name, event: None)
+        report = RunReport()
+        excluded = set(exclude)
+        pending = [name for name in self.order if name not in excluded]
+        finished = set(excluded)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    if not self.upstream[name] <= finished:
+                        continue
+                    pending.remove(name)
+                    node = self.nodes[name]
+                    fingerprint = _fingerprint(node, patient)
+                    outputs_ready = all(getattr(patient, out) for out in node.outputs)
+                    if not (force or refresh) and outputs_ready and cache.get(name) == fingerprint:
+                        report.skipped.append(name)
+                        finished.add(name)
+                        notify(name, "skip")
+                        continue
+                    notify(name, "start")
+                    future = pool.submit(self._timed, node, patient, api_key, vectorstore, refresh)
+                    running[future] = (name, fingerprint)
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, fingerprint = running.pop(future)
+                    result, seconds = future.result()
+                    node = self.nodes[name]
+                    for key, value in result.items():
+                        if key in node.outputs:
+                            setattr(patient, key, value)
+                        else:
+                            report.artifacts.setdefault(name, {})[key] = value
+                    cache[name] = fingerprint
+                    report.ran.append(name)
+                    report.durations[name] = seconds
+                    finished.add(name)
+                    notify(name, "done")
+
+        return report
+
+    @staticmethod
+    def _timed(
+        node: Node, patient: PatientState, api_key: str, vectorstore, refresh: bool,
+    ) -> Tuple[dict, float]:
+        start = time.perf_counter()
+        result = node.run(patient, api_key, vectorstore, refresh) or {}
+        return result, time.perf_counter() - start
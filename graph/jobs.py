@@ -0,0 +1,190 @@
+"""
+UtopIA — Tâches en arrière-plan
+File de tâches du processus (pool de threads) pour les appels LLM longs :
+une tâche est détachée de l'exécution du script Streamlit, survit donc aux reruns
+(navigation, interaction avec un widget), et la page la retrouve par sa clé pour
+suivre sa progression et récupérer son résultat.
+
+    key = jobs.session_key(session_id, "diagnostic")
+    jobs.submit_stream(key, stream_diagnostic, patient, api_key, vectorstore)
+    job = jobs.get(key)  # job.partial_text, job.done(), job.result()
+    if job is not None:
+        jobs.follow(job, on_progress=..., on_done=..., on_error=...)
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterator, List, Optional
+
+JOB_WORKERS = int(os.environ.get("UTOPIA_JOB_WORKERS", "4"))
+MAX_JOBS = 256  # tâches terminées conservées, les plus anciennes sont oubliées
+
+# Valeur à passer en argument d'une tâche : remplacée par job.log.append
+# (ex. on_step=jobs.PROGRESS pour suivre les étapes de run_preconisation)
+PROGRESS = object()
+
+
+class Job:
+    def __init__(self, key: str):
+        self.key = key
+        self.started = time.time()
+        self.log: List[str] = []      # étapes signalées par la tâche
+        self.partial: List[str] = []  # texte produit jusqu'ici (tâches streamées)
+        self.cancelled = threading.Event()
+        self.future: Optional[Future] = None
+
+    @property
+    def partial_text(self) -> str:
+        return "".join(self.partial)
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - self.started
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def failed(self) -> bool:
+        return self.future.done() and self.future.exception() is not None
+
+    def result(self, timeout: Optional[float] = None):
+        return self.future.result(timeout)
+
+    def wait(self, poll: float = 0.2, on_progress: Optional[Callable[["Job"], None]] = None):
+        """Attend la fin de la tâche en appelant `on_progress(job)` à intervalle régulier."""
+        while not self.done():
+            if on_progress:
+                on_progress(self)
+            time.sleep(poll)
+        return self.result()
+
+
+_LOCK = threading.Lock()
+_EXECUTOR: Optional[ThreadPoolExecutor] = None
+_JOBS: "OrderedDict[str, Job]" = OrderedDict()
+
+
+def _executor() -> ThreadPoolExecutor:
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="utopia-job")
+    return _EXECUTOR
+
+
+def _prune() -> None:
+    for key in list(_JOBS):
+        if len(_JOBS) <= MAX_JOBS:
+            break
+        if _JOBS[key].done():
+            del _JOBS[key]
+
+
+def session_key(session_id: str, job_id: str) -> str:
+    return session_id + "/" + job_id
+
+
+def _start(key: str, run: Callable[[Job], object], replace: bool = False) -> Job:
+    with _LOCK:
+        job = _JOBS.get(key)
+        if job is not None and not job.failed():
+            if not replace:
+                return job
+            job.cancelled.set()
+        job = Job(key)
+        job.future = _executor().submit(run, job)
+        _JOBS[key] = job
+        _prune()
+        return job
+
+
+def submit(key: str, fn: Callable, *args, **kwargs) -> Job:
+    """
+    Lance `fn(*args, **kwargs)` en arrière-plan sous la clé `key`.
+    Une tâche en cours ou réussie pour la même clé est réutilisée (pas de double appel) ;
+    une tâche échouée est relancée. Avec refresh=True dans `kwargs`, la tâche existante est
+    remplacée (et interrompue si elle est streamée) : la rejoindre perdrait le refresh.
+    Retirer la tâche (pop, ou follow) une fois son résultat consommé.
+    """
+    def run(job: Job):
+        def resolve(value):
+            return job.log.append if value is PROGRESS else value
+        return fn(*[resolve(a) for a in args], **{k: resolve(v) for k, v in kwargs.items()})
+
+    return _start(key, run, replace=bool(kwargs.get("refresh")))
+
+
+def submit_stream(key: str, stream_fn: Callable[..., Iterator[str]], *args, **kwargs) -> Job:
+    """Comme submit, pour une fonction qui produit du texte au fil de l'eau ; le résultat est le texte complet."""
+    def run(job: Job) -> str:
+        chunks = stream_fn(*args, **kwargs)
+        for chunk in chunks:
+            job.partial.append(chunk)
+            if job.cancelled.is_set():
+                chunks.close()  # referme le flux API (la réservation de tokens est ajustée)
+                break
+        return job.partial_text
+
+    return _start(key, run, replace=bool(kwargs.get("refresh")))
+
+
+def get(key: str) -> Optional[Job]:
+    with _LOCK:
+        return _JOBS.get(key)
+
+
+def pop(key: str) -> Optional[Job]:
+    with _LOCK:
+        return _JOBS.pop(key, None)
+
+
+def _discard(job: Job) -> None:
+    # Retire `job` s'il est toujours la tâche de sa clé (et non une tâche qui l'a remplacé)
+    with _LOCK:
+        if _JOBS.get(job.key) is job:
+            del _JOBS[job.key]
+
+
+def follow(
+    job: Job,
+    on_progress: Callable[[Job], None],
+    on_done: Callable[[Any], None],
+    on_error: Callable[[str], None],
+) -> None:
+    """
+    Suivi d'une tâche depuis une page : `on_progress(job)` à intervalle régulier pendant
+    l'attente, puis la tâche est retirée et `on_done(résultat)` ou `on_error(message)` appelé.
+    `on_progress` doit afficher quelque chose (st.*) : c'est à ces appels que Streamlit
+    interrompt le script sur un clic. Un rerun pendant l'attente n'arrête que l'affichage,
+    la tâche est retrouvée par sa clé au suivant.
+    """
+    try:
+        result = job.wait(on_progress=on_progress)
+    except Exception as e:
+        _discard(job)
+        on_error("Erreur : " + type(e).__name__ + " — " + str(e))
+        return
+    _discard(job)
+    on_done(result)
+
+
+def cancel(key: str) -> Optional[Job]:
+    """
+    Retire la tâche : elle n'est pas lancée si elle attend encore un thread,
+    une tâche streamée s'interrompt au fragment suivant.
+    """
+    job = pop(key)
+    if job is not None:
+        job.cancelled.set()
+        job.future.cancel()
+    return job
+
+
+def cancel_prefix(prefix: str, keep: Optional[str] = None) -> None:
+    """Annule (cf. cancel) toutes les tâches dont la clé commence par `prefix`, sauf `keep`."""
+    with _LOCK:
+        keys = [key for key in _JOBS if key.startswith(prefix) and key != keep]
+    for key in keys:
+        cancel(key)
@@ -0,0 +1,458 @@
+"""
+UtopIA — Client LLM partagé
+Clients Anthropic (sync / async) partagés par clé API ; tous les appels des nodes passent par
+create_message / stream_message / create_structured : mémoïsation (graph.memo), ordonnancement
+(graph.scheduler) et mesure de chaque appel (graph.telemetry).
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import weakref
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple, Type, TypeVar
+
+from anthropic import (
+    DEFAULT_CONNECTION_LIMITS, Anthropic, AsyncAnthropic,
+    DefaultAsyncHttpxClient, DefaultHttpxClient, Timeout,
+)
+from anthropic.types import Message
+from pydantic import BaseModel, ValidationError
+
+from graph import memo, scheduler, telemetry
+from utils.tokens import request_tokens
+
+# Classe Limits du client HTTP embarqué par le SDK (httpx ou httpx2 selon la version)
+Limits = type(DEFAULT_CONNECTION_LIMITS)
+
+MAX_CONNECTIONS = int(os.environ.get("UTOPIA_LLM_MAX_CONNECTIONS", "20"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("UTOPIA_LLM_MAX_KEEPALIVE", "10"))
+KEEPALIVE_EXPIRY = float(os.environ.get("UTOPIA_LLM_KEEPALIVE_EXPIRY", "120"))
+REQUEST_TIMEOUT = float(os.environ.get("UTOPIA_LLM_TIMEOUT", "120"))
+CONNECT_TIMEOUT = float(os.environ.get("UTOPIA_LLM_CONNECT_TIMEOUT", "10"))
+
+# Marqueur de prompt caching : le préfixe jusqu'à ce bloc est réutilisé ~5 min côté API.
+# En deçà de la taille minimale cacheable du modèle, l'API ignore simplement le marqueur :
+# 2048 tokens pour Claude 3 Haiku (niveau rapide), 1024 pour Sonnet 4.5 (intermédiaire),
+# 4096 pour Opus 4.5 (qualité). Prompt système (~100-200 tokens) + contexte RAG fixe
+# (≤ UTOPIA_RAG_TOKEN_BUDGET, 800 par défaut) restent sous le seuil du niveau rapide et
+# du niveau qualité ; seuls les nodes du niveau intermédiaire (outil JSON compris) peuvent
+# l'atteindre, ainsi que les tours d'entretien dont l'historique transmis dépasse ~1700 tokens
+# (cf. HISTORY_TOKEN_BUDGET dans graph.nodes.chat_clinique). cache_read_input_tokens
+# (graph.telemetry) indique où le cache sert réellement.
+CACHE_CONTROL = {"type": "ephemeral"}
+
+USAGE_FIELDS = (
+    "input_tokens", "output_tokens",
+    "cache_creation_input_tokens", "cache_read_input_tokens",
+)
+
+_LOCK = threading.Lock()
+_CLIENTS: Dict[str, Anthropic] = {}
+
+logger = logging.getLogger(__name__)
+
+Schema = TypeVar("Schema", bound=BaseModel)
+
+
+def _limits() -> Limits:
+    return Limits(
+        max_connections=MAX_CONNECTIONS,
+        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+
+
+def _timeout() -> Timeout:
+    return Timeout(REQUEST_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+
+def get_client(api_key: str) -> Anthropic:
+    """Client Anthropic partagé pour cette clé (créé au premier appel, thread-safe)."""
+    with _LOCK:
+        client = _CLIENTS.get(api_key)
+        if client is None:
+            client = Anthropic(
+                api_key=api_key,
+                timeout=_timeout(),
+                max_retries=0,
+                http_client=DefaultHttpxClient(limits=_limits()),
+            )
+            _CLIENTS[api_key] = client
+        return client
+
+
+def cached_system(text: str) -> List[dict]:
+    """Prompt système sous forme de bloc cacheable."""
+    return [{"type": "text", "text": text, "cache_control": CACHE_CONTROL}]
+
+
+def cached_content(reference: str, prompt: str) -> List[dict]:
+    """
+    Contenu d'un message utilisateur : le bloc de référence stable (contexte RAG fixe)
+    en tête, marqué cacheable, puis la partie propre au patient.
+    """
+    blocks = []
+    if reference:
+        blocks.append({"type": "text", "text": reference, "cache_control": CACHE_CONTROL})
+    blocks.append({"type": "text", "text": prompt})
+    return blocks
+
+
+def _record_usage(node: str, request: dict, message: Message) -> Dict[str, int]:
+    usage = {name: getattr(message.usage, name, None) or 0 for name in USAGE_FIELDS}
+    logger.info(
+        "%s (%s) : ~%d tokens d'entrée estimés, %d facturés + %d écrits / %d lus dans le cache, %d en sortie",
+        node, request.get("model"), request_tokens(request), usage["input_tokens"],
+        usage["cache_creation_input_tokens"], usage["cache_read_input_tokens"], usage["output_tokens"],
+    )
+    return usage
+
+
+def _create(
+    api_key: str, node: str, refresh: bool, request: dict,
+    schema: Optional[Type[Schema]] = None,
+) -> Tuple[Message, telemetry.Call, Optional[Schema], Optional[Exception]]:
+    """
+    messages.create mémoïsé et mesuré ; l'appelant enregistre la mesure (call.save()).
+    Avec `schema`, seule une sortie valide est mémoïsée : une entrée du cache qui ne
+    valide pas (schéma modifié depuis) est supprimée et la requête repart à l'API.
+    Retourne le message, la mesure, puis le résultat validé et l'erreur de validation.
+    """
+    call = telemetry.Call(node, request.get("model"))
+    key = memo.fingerprint(node, request)
+    if not refresh:
+        cached = memo.get(key)
+        if cached is not None:
+            message = Message.model_validate(cached)
+            result, error = _try_parse(message, schema) if schema else (None, None)
+            if error is None:
+                call.memo_hit = True
+                call.finish()
+                return message, call, result, None
+            memo.delete(key)
+
+    client = get_client(api_key)
+    try:
+        message = scheduler.submit(
+            api_key, node, request, lambda: client.messages.create(**request), on_retry=call.retry,
+        )
+    except Exception as e:
+        call.fail(e)
+        raise
+    usage = _record_usage(node, request, message)
+    call.finish(usage)
+    result, error = _try_parse(message, schema) if schema else (None, None)
+    call.parse_failures = int(error is not None)
+    if error is None:
+        memo.put(key, node, message.model_dump(mode="json"))
+    return message, call, result, error
+
+
+def create_message(
+    api_key: str,
+    node: str,
+    refresh: bool = False,
+    **request,
+) -> Message:
+    """
+    messages.create mémoïsé : une requête identique pour le même node est servie
+    depuis le cache persistant (cf. graph.memo).
+    """
+    message, call, _, _ = _create(api_key, node, refresh, request)
+    call.save()
+    return message
+
+
+def stream_message(
+    api_key: str,
+    node: str,
+    refresh: bool = False,
+    **request,
+) -> Iterator[str]:
+    """Variante streamée de create_message : un hit de cache est restitué d'un bloc."""
+    call = telemetry.Call(node, request.get("model"), streamed=True)
+    key = memo.fingerprint(node, request)
+    if not refresh:
+        cached = memo.get(key)
+        if cached is not None:
+            call.memo_hit = True
+            call.save()
+            yield message_text(Message.model_validate(cached))
+            return
+
+    # Seule l'ouverture du flux est reprise en cas de surcharge : une fois le texte
+    # transmis à l'appelant, une nouvelle tentative le dupliquerait.
+    client = get_client(api_key)
+
+    def open_stream():
+        manager = client.messages.stream(**request)
+        return manager, manager.__enter__()
+
+    try:
+        manager, stream = scheduler.submit(api_key, node, request, open_stream, on_retry=call.retry)
+    except Exception as e:
+        call.fail(e)
+        raise
+    message = None
+    interrupted: Optional[BaseException] = None
+    try:
+        for text in stream.text_stream:
+            call.first_token()
+            yield text
+        message = stream.get_final_message()
+    except BaseException as e:
+        interrupted = e  # erreur en cours de flux, ou appelant qui abandonne (GeneratorExit)
+        raise
+    finally:
+        manager.__exit__(None, None, None)
+        if message is None:
+            _settle_interrupted(api_key, request, stream, call, interrupted)
+    scheduler.settle(api_key, request, message)
+    usage = _record_usage(node, request, message)
+    call.finish(usage)
+    call.save()
+    memo.put(key, node, message.model_dump(mode="json"))
+
+
+def _settle_interrupted(api_key: str, request: dict, stream, call: telemetry.Call, error) -> None:
+    """
+    Flux interrompu (erreur ou appelant qui abandonne) : la réservation de l'ordonnanceur
+    est ajustée sur l'usage partiel connu (tokens d'entrée dès message_start), ou rendue
+    entièrement, et l'appel est tout de même enregistré dans la télémétrie.
+    """
+    try:
+        partial = stream.current_message_snapshot
+    except Exception:
+        partial = None
+    scheduler.settle(api_key, request, partial)
+    usage = {name: getattr(partial.usage, name, None) or 0 for name in USAGE_FIELDS} if partial else None
+    call.fail(error or RuntimeError("flux interrompu"), usage)
+
+
+def message_text(message: Message) -> str:
+    """Concatène les blocs texte d'une réponse."""
+    return "".join(block.text for block in message.content if block.type == "text")
+
+
+def _parse_tool_output(message: Message, schema: Type[Schema]) -> Schema:
+    for block in message.content:
+        if block.type == "tool_use" and block.name == schema.__name__:
+            return schema.model_validate(block.input)
+    raise ValueError("Aucun appel de l'outil " + schema.__name__ + " dans la réponse")
+
+
+def _repair_turns(message: Message, error: Exception) -> List[dict]:
+    """Renvoie au modèle sa réponse et l'erreur de validation pour une seconde tentative."""
+    feedback = "Sortie invalide, corrige-la et rappelle l'outil : " + str(error)
+    tool_use = next((block for block in message.content if block.type == "tool_use"), None)
+    if tool_use is None:
+        return [
+            {"role": "assistant", "content": message_text(message) or "(vide)"},
+            {"role": "user", "content": feedback},
+        ]
+    return [
+        {"role": "assistant", "content": [{
+            "type": "tool_use", "id": tool_use.id, "name": tool_use.name, "input": tool_use.input,
+        }]},
+        {"role": "user", "content": [{
+            "type": "tool_result", "tool_use_id": tool_use.id,
+            "is_error": True, "content": feedback,
+        }]},
+    ]
+
+
+def _structured_request(schema: Type[Schema], request: dict) -> dict:
+    tool = {
+        "name": schema.__name__,
+        "description": (schema.__doc__ or schema.__name__).strip(),
+        "input_schema": schema.model_json_schema(),
+    }
+    return dict(request, tools=[tool], tool_choice={"type": "tool", "name": schema.__name__})
+
+
+def _try_parse(message: Message, schema: Type[Schema]) -> Tuple[Optional[Schema], Optional[Exception]]:
+    try:
+        return _parse_tool_output(message, schema), None
+    except (ValidationError, ValueError) as e:
+        return None, e
+
+
+def create_structured(
+    api_key: str,
+    node: str,
+    schema: Type[Schema],
+    refresh: bool = False,
+    **request,
+) -> Optional[Schema]:
+    """
+    Appel à sortie structurée : le schéma pydantic est imposé comme unique outil,
+    la réponse est validée et, si elle est invalide, une seule réparation est tentée.
+    Retourne None si la seconde réponse est encore invalide (le node applique son repli).
+    """
+    request = _structured_request(schema, request)
+
+    # Une sortie invalide n'est jamais mémoïsée (cf. _create) : chaque réparation est un appel réel
+    message, call, result, error = _create(api_key, node, refresh, request, schema)
+    call.save()
+    if error is None:
+        return result
+
+    # La réponse réparée est aussi mémoïsée sous la requête d'origine :
+    # une relance identique est servie par le cache, sans refaire les deux appels.
+    original_key = memo.fingerprint(node, request)
+    request["messages"] = list(request["messages"]) + _repair_turns(message, error)
+    message, call, result, error = _create(api_key, node, refresh, request, schema)
+    call.save()
+    if error is None:
+        memo.put(original_key, node, message.model_dump(mode="json"))
+    return result
+
+
+# ── API asynchrone ──────────────────────────────────────────────────────────
+# Un client AsyncAnthropic par boucle d'événements et par clé : son pool de connexions
+# est lié à la boucle qui l'a créé. Toutes les sessions servies par une même boucle
+# partagent donc un seul client et multiplexent leurs requêtes dessus.
+# Le cache des nodes et la télémétrie sont en SQLite : leurs accès passent par
+# asyncio.to_thread pour ne pas bloquer la boucle pendant une écriture.
+
+_ASYNC_CLIENTS: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, AsyncAnthropic]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def get_async_client(api_key: str) -> AsyncAnthropic:
+    """Client AsyncAnthropic partagé pour cette clé sur la boucle d'événements courante."""
+    loop = asyncio.get_running_loop()
+    with _LOCK:
+        clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        client = clients.get(api_key)
+        if client is None:
+            client = AsyncAnthropic(
+                api_key=api_key,
+                timeout=_timeout(),
+                max_retries=0,
+                http_client=DefaultAsyncHttpxClient(limits=_limits()),
+            )
+            clients[api_key] = client
+        return client
+
+
+async def _acreate(
+    api_key: str, node: str, refresh: bool, request: dict,
+    schema: Optional[Type[Schema]] = None,
+) -> Tuple[Message, telemetry.Call, Optional[Schema], Optional[Exception]]:
+    """Version asynchrone de _create."""
+    call = telemetry.Call(node, request.get("model"))
+    key = memo.fingerprint(node, request)
+    if not refresh:
+        cached = await asyncio.to_thread(memo.get, key)
+        if cached is not None:
+            message = Message.model_validate(cached)
+            result, error = _try_parse(message, schema) if schema else (None, None)
+            if error is None:
+                call.memo_hit = True
+                call.finish()
+                return message, call, result, None
+            await asyncio.to_thread(memo.delete, key)
+
+    client = get_async_client(api_key)
+    try:
+        message = await scheduler.asubmit(
+            api_key, node, request, lambda: client.messages.create(**request), on_retry=call.retry,
+        )
+    except Exception as e:
+        await asyncio.to_thread(call.fail, e)
+        raise
+    usage = _record_usage(node, request, message)
+    call.finish(usage)
+    result, error = _try_parse(message, schema) if schema else (None, None)
+    call.parse_failures = int(error is not None)
+    if error is None:
+        await asyncio.to_thread(memo.put, key, node, message.model_dump(mode="json"))
+    return message, call, result, error
+
+
+async def acreate_message(
+    api_key: str,
+    node: str,
+    refresh: bool = False,
+    **request,
+) -> Message:
+    """Version asynchrone de create_message (même mémoïsation)."""
+    message, call, _, _ = await _acreate(api_key, node, refresh, request)
+    await asyncio.to_thread(call.save)
+    return message
+
+
+async def astream_message(
+    api_key: str,
+    node: str,
+    refresh: bool = False,
+    **request,
+) -> AsyncIterator[str]:
+    """Version asynchrone de stream_message."""
+    call = telemetry.Call(node, request.get("model"), streamed=True)
+    key = memo.fingerprint(node, request)
+    if not refresh:
+        cached = await asyncio.to_thread(memo.get, key)
+        if cached is not None:
+            call.memo_hit = True
+            await asyncio.to_thread(call.save)
+            yield message_text(Message.model_validate(cached))
+            return
+
+    client = get_async_client(api_key)
+
+    async def open_stream():
+        manager = client.messages.stream(**request)
+        return manager, await manager.__aenter__()
+
+    try:
+        manager, stream = await scheduler.asubmit(api_key, node, request, open_stream, on_retry=call.retry)
+    except Exception as e:
+        await asyncio.to_thread(call.fail, e)
+        raise
+    message = None
+    interrupted: Optional[BaseException] = None
+    try:
+        async for text in stream.text_stream:
+            call.first_token()
+            yield text
+        message = await stream.get_final_message()
+    except BaseException as e:
+        interrupted = e
+        raise
+    finally:
+        await manager.__aexit__(None, None, None)
+        if message is None:
+            await asyncio.to_thread(_settle_interrupted, api_key, request, stream, call, interrupted)
+    scheduler.settle(api_key, request, message)
+    usage = _record_usage(node, request, message)
+    call.finish(usage)
+    await asyncio.to_thread(call.save)
+    await asyncio.to_thread(memo.put, key, node, message.model_dump(mode="json"))
+
+
+async def acreate_structured(
+    api_key: str,
+    node: str,
+    schema: Type[Schema],
+    refresh: bool = False,
+    **request,
+) -> Optional[Schema]:
+    """Version asynchrone de create_structured (même réparation unique)."""
+    request = _structured_request(schema, request)
+
+    message, call, result, error = await _acreate(api_key, node, refresh, request, schema)
+    await asyncio.to_thread(call.save)
+    if error is None:
+        return result
+
+    original_key = memo.fingerprint(node, request)
+    request["messages"] = list(request["messages"]) + _repair_turns(message, error)
+    message, call, result, error = await _acreate(api_key, node, refresh, request, schema)
+    await asyncio.to_thread(call.save)
+    if error is None:
+        await asyncio.to_thread(memo.put, original_key, node, message.model_dump(mode="json"))
+    return result
@@ -0,0 +1,113 @@
+"""
+UtopIA — Mémoïsation des nodes
+Cache persistant des réponses LLM indexé par l'empreinte exacte des entrées d'un node :
+nom du node et requête complète (modèle, system, messages, schéma imposé comme outil —
+donc prompts, champs patient et contexte RAG inclus). Une requête identique est servie
+sans nouvel appel payant ; `refresh=True` force une vraie régénération.
+Aucune version de prompt à maintenir : modifier un prompt ou un schéma change la requête,
+donc la clé. Le message brut est stocké et chaque node l'analyse à la lecture : modifier
+ce parsing ne rend pas non plus les entrées obsolètes (une entrée qui ne valide plus
+son schéma est supprimée, cf. graph.llm).
+Les réponses contiennent des données cliniques : les entrées expirent après
+UTOPIA_CACHE_MAX_AGE_DAYS jours, le cache est borné à UTOPIA_CACHE_MAX_ENTRIES entrées
+(les plus anciennes sont supprimées) et purge() l'efface.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+CACHE_DIR = Path(os.environ.get("UTOPIA_CACHE_DIR", str(BASE_DIR / ".cache")))
+NODE_CACHE_ENABLED = os.environ.get("UTOPIA_NODE_CACHE", "1") != "0"
+MAX_ENTRIES = int(os.environ.get("UTOPIA_CACHE_MAX_ENTRIES", "2000"))
+MAX_AGE = float(os.environ.get("UTOPIA_CACHE_MAX_AGE_DAYS", "30")) * 86400
+
+_LOCK = threading.Lock()
+_CONN: Optional[sqlite3.Connection] = None
+
+
+def _connection() -> sqlite3.Connection:
+    global _CONN
+    if _CONN is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _CONN = sqlite3.connect(str(CACHE_DIR / "node_outputs.sqlite"), check_same_thread=False)
+        _CONN.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            "key TEXT PRIMARY KEY, node TEXT NOT NULL, created REAL NOT NULL, value TEXT NOT NULL)"
+        )
+        _CONN.execute("CREATE INDEX IF NOT EXISTS outputs_created ON outputs (created)")
+        _prune(_CONN)
+        _CONN.commit()
+    return _CONN
+
+
+def _prune(conn: sqlite3.Connection) -> None:
+    """Supprime les entrées expirées puis les plus anciennes au-delà de MAX_ENTRIES."""
+    conn.execute("DELETE FROM outputs WHERE created < ?", (time.time() - MAX_AGE,))
+    conn.execute(
+        "DELETE FROM outputs WHERE key IN ("
+        "SELECT key FROM outputs ORDER BY created DESC LIMIT -1 OFFSET ?)",
+        (MAX_ENTRIES,),
+    )
+
+
+def fingerprint(node: str, request: dict) -> str:
+    raw = json.dumps(
+        {"node": node, "request": request},
+        sort_keys=True, ensure_ascii=False, default=str,
+    ).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def get(key: str) -> Optional[dict]:
+    if not NODE_CACHE_ENABLED:
+        return None
+    with _LOCK:
+        row = _connection().execute(
+            "SELECT value FROM outputs WHERE key = ? AND created >= ?", (key, time.time() - MAX_AGE)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def put(key: str, node: str, value: dict) -> None:
+    if not NODE_CACHE_ENABLED:
+        return
+    with _LOCK:
+        conn = _connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO outputs (key, node, created, value) VALUES (?, ?, ?, ?)",
+            (key, node, time.time(), json.dumps(value, ensure_ascii=False)),
+        )
+        _prune(conn)
+        conn.commit()
+
+
+def delete(key: str) -> None:
+    if not NODE_CACHE_ENABLED:
+        return
+    with _LOCK:
+        conn = _connection()
+        conn.execute("DELETE FROM outputs WHERE key = ?", (key,))
+        conn.commit()
+
+
+def purge(node: Optional[str] = None) -> int:
+    """
+    Efface le cache (ou les seules réponses de `node`) et compacte le fichier pour que
+    les données supprimées ne restent pas sur le disque. Retourne le nombre d'entrées effacées.
+    """
+    with _LOCK:
+        conn = _connection()
+        if node is None:
+            deleted = conn.execute("DELETE FROM outputs").rowcount
+        else:
+            deleted = conn.execute("DELETE FROM outputs WHERE node = ?", (node,)).rowcount
+        conn.commit()
+        conn.execute("VACUUM")
+    return deleted
@@ -2,9 +2,16 @@
 UtopIA — Node 4 : Rédaction de l'argumentaire CPAM
 """
 
-import json
-import re
-from anthropic import Anthropic
+import asyncio
+from typing import AsyncIterator, Iterator
+
+from graph.llm import (
+    acreate_message, acreate_structured, astream_message,
+    cached_content, cached_system, create_message, create_structured, stream_message,
+)
+from graph.prompt import profile, section
+from graph.routing import DRAFT, FINAL, model_for
+from graph.schemas import ResumeCPAM
 from graph.state import PatientState
 
 SYSTEM_PROMPT = """Tu es UtopIA, ergothérapeute expert rédacteur d'argumentaires de prise en charge VPH.
@@ -12,25 +19,26 @@ Tu rédiges des argumentaires CPAM professionnels, conformes à la réglementati
 Tes argumentaires sont cliniquement justifiés, référencés à la nomenclature, centrés sur la participation sociale."""
 
 
-def write_argumentaire(patient: PatientState, api_key: str, vectorstore=None) -> str:
-    client = Anthropic(api_key=api_key)
-
+def _build_prompt(patient: PatientState, vectorstore=None) -> list:
     rag_section = ""
     if vectorstore:
         try:
-            from rag.retriever import search, format_context
-            docs = search(
-                "prise en charge remboursement prescription CPAM reforme VPH",
-                k=4,
-                vectorstore=vectorstore,
-                category_filter="reglementation"
-            )
-            if docs:
-                rag_section = "Références réglementaires :\n" + format_context(docs)
+            from rag.retriever import get_fixed_context
+            context = get_fixed_context("argumentaire", vectorstore)
+            if context:
+                rag_section = "Références réglementaires :\n" + context
         except Exception:
             pass
 
     at_essayees_str = ", ".join(patient.at_essayees) if patient.at_essayees else "Non renseigné"
+    essais = {
+        name: section("write_argumentaire", name, getattr(patient, field)) or "Non renseigné"
+        for name, field in (
+            ("observations", "observations_essais"),
+            ("motifs_rejet", "motifs_rejet"),
+            ("reglages", "reglages_definitifs"),
+        )
+    }
 
     propositions_str = ""
     if patient.propositions_at:
@@ -45,17 +53,17 @@ def write_argumentaire(patient: PatientState, api_key: str, vectorstore=None) ->
         "Rédige l'argumentaire complet de prise en charge pour ce dossier CPAM.",
         "",
         "DONNÉES PATIENT :",
-        patient.to_context_summary(),
+        profile(patient, "write_argumentaire"),
         "",
         "DIAGNOSTIC ERGOTHÉRAPIQUE :",
-        (patient.diagnostic_ergo[:600] if patient.diagnostic_ergo else "Non disponible"),
+        (section("write_argumentaire", "diagnostic", patient.diagnostic_ergo) or "Non disponible"),
         "",
         "PARCOURS D'ESSAI :",
         "VPH essayés : " + at_essayees_str,
         "VPH retenu : " + (patient.at_retenue or "Non renseigné"),
-        "Observations : " + (patient.observations_essais or "Non renseigné"),
-        "Motifs de rejet : " + (patient.motifs_rejet or "Non renseigné"),
-        "Réglages définitifs : " + (patient.reglages_definitifs or "Non renseigné"),
+        "Observations : " + essais["observations"],
+        "Motifs de rejet : " + essais["motifs_rejet"],
+        "Réglages définitifs : " + essais["reglages"],
     ]
 
     if propositions_str:
@@ -63,10 +71,6 @@ def write_argumentaire(patient: PatientState, api_key: str, vectorstore=None) ->
         lines.append("PRÉCONISATIONS ÉTUDIÉES :")
         lines.append(propositions_str)
 
-    if rag_section:
-        lines.append("")
-        lines.append(rag_section)
-
     vph_retenu = patient.at_retenue or "VPH préconisé"
     lines += [
         "",
@@ -81,20 +85,94 @@ def write_argumentaire(patient: PatientState, api_key: str, vectorstore=None) ->
         "",
         "Rédige en 400-600 mots, phrases complètes, pas de tirets.",
     ]
-
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+    return cached_content(rag_section, "\n".join(lines))
+
+
+FINAL_INSTRUCTION = """Voici ton brouillon, relu et éventuellement modifié par l'ergothérapeute.
+Rédige la version finale de cet argumentaire : conserve les modifications, les formulations et les choix
+cliniques de l'ergothérapeute, ne réintroduis aucun passage supprimé, garde la même structure.
+Corrige la langue, renforce la justification clinique et réglementaire à partir des données du dossier.
+Réponds uniquement avec l'argumentaire final."""
+
+
+def _request(patient: PatientState, vectorstore=None, mode: str = DRAFT) -> dict:
+    """
+    mode "draft" : brouillon rapide ; mode "final" : passe de qualité (cf. graph.routing)
+    qui part du brouillon courant (patient.argumentaire_cpam, modifications comprises).
+    """
+    messages = [{"role": "user", "content": _build_prompt(patient, vectorstore)}]
+    if mode == FINAL and patient.argumentaire_cpam:
+        messages += [
+            {"role": "assistant", "content": patient.argumentaire_cpam},
+            {"role": "user", "content": FINAL_INSTRUCTION},
+        ]
+    return dict(
+        model=model_for("write_argumentaire", mode),
         max_tokens=1500,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": "\n".join(lines)}]
+        system=cached_system(SYSTEM_PROMPT),
+        messages=messages,
+    )
+
+
+def write_argumentaire(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+    mode: str = DRAFT,
+) -> str:
+    response = create_message(
+        api_key, "write_argumentaire", refresh=refresh,
+        **_request(patient, vectorstore, mode)
     )
 
     return response.content[0].text
 
 
-def generate_cpam_summary(patient: PatientState, api_key: str) -> dict:
-    client = Anthropic(api_key=api_key)
+def stream_argumentaire(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+    mode: str = DRAFT,
+) -> Iterator[str]:
+    """Variante streamée de write_argumentaire : produit le texte au fil de la génération."""
+    yield from stream_message(
+        api_key, "write_argumentaire", refresh=refresh,
+        **_request(patient, vectorstore, mode)
+    )
+
+
+async def awrite_argumentaire(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+    mode: str = DRAFT,
+) -> str:
+    response = await acreate_message(
+        api_key, "write_argumentaire", refresh=refresh,
+        **await asyncio.to_thread(_request, patient, vectorstore, mode)
+    )
+
+    return response.content[0].text
 
+
+async def astream_argumentaire(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+    mode: str = DRAFT,
+) -> AsyncIterator[str]:
+    async for text in astream_message(
+        api_key, "write_argumentaire", refresh=refresh,
+        **await asyncio.to_thread(_request, patient, vectorstore, mode)
+    ):
+        yield text
+
+
+def _cpam_request(patient: PatientState) -> dict:
     lines = [
         "Pour ce dossier VPH, extrais les informations clés pour les fiches CPAM.",
         "",
@@ -103,20 +181,29 @@ def generate_cpam_summary(patient: PatientState, api_key: str) -> dict:
         "VPH retenu : " + (patient.at_retenue or ""),
         "Catégorie : " + (patient.categorie_vph_recommandee or ""),
         "",
-        'Réponds en JSON : {"categorie_vph":"...","mode_prise_en_charge":"achat|LCD|LLD","justification_courte":"...","points_cles":["...","...","..."]}',
+        "Réponds avec l'outil ResumeCPAM.",
     ]
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+    return dict(
+        model=model_for("generate_cpam_summary"),
         max_tokens=400,
         messages=[{"role": "user", "content": "\n".join(lines)}]
     )
 
-    text = response.content[0].text
-    match = re.search(r'\{.*\}', text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group())
-        except Exception:
-            pass
-    return {}
+
+def generate_cpam_summary(patient: PatientState, api_key: str, refresh: bool = False) -> dict:
+    result = create_structured(
+        api_key, "generate_cpam_summary", ResumeCPAM, refresh=refresh,
+        **_cpam_request(patient)
+    )
+
+    return result.model_dump() if result is not None else {}
+
+
+async def agenerate_cpam_summary(patient: PatientState, api_key: str, refresh: bool = False) -> dict:
+    result = await acreate_structured(
+        api_key, "generate_cpam_summary", ResumeCPAM, refresh=refresh,
+        **_cpam_request(patient)
+    )
+
+    return result.model_dump() if result is not None else {}
@@ -2,9 +2,13 @@
 UtopIA — Node 3 : Recherche des aides techniques
 """
 
-import json
-import re
-from anthropic import Anthropic
+import asyncio
+from graph.llm import (
+    acreate_message, acreate_structured, cached_content, cached_system, create_message, create_structured,
+)
+from graph.prompt import profile, section
+from graph.routing import model_for
+from graph.schemas import PropositionsAT
 from graph.state import PatientState
 
 SYSTEM_PROMPT = """Tu es UtopIA, ergothérapeute expert en préconisation de VPH selon la nomenclature française (réforme décembre 2025).
@@ -19,120 +23,144 @@ Tu connais parfaitement :
 - Les critères cliniques de choix"""
 
 
-def determine_vph_category(patient: PatientState, api_key: str, vectorstore=None) -> str:
-    client = Anthropic(api_key=api_key)
-
+def _category_request(patient: PatientState, vectorstore=None) -> dict:
     rag_section = ""
     if vectorstore:
         try:
-            from rag.retriever import search, format_context
-            docs = search(
-                "indications categorie VPH fauteuil roulant prescription",
-                k=4,
-                vectorstore=vectorstore,
-                category_filter="reglementation"
-            )
-            if docs:
-                rag_section = "Références :\n" + format_context(docs)
+            from rag.retriever import get_fixed_context
+            context = get_fixed_context("categorie_vph", vectorstore)
+            if context:
+                rag_section = "Références :\n" + context
         except Exception:
             pass
 
     lines = [
         "Selon ce profil, quelle est la catégorie VPH la plus adaptée ?",
         "",
-        patient.to_context_summary(),
+        profile(patient, "determine_vph_category"),
     ]
-    if rag_section:
-        lines.append("")
-        lines.append(rag_section)
     lines += [
         "",
         "Réponds UNIQUEMENT avec le code catégorie suivi d'une courte justification.",
         "Format : CODE | Justification"
     ]
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+    return dict(
+        model=model_for("determine_vph_category"),
         max_tokens=200,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": "\n".join(lines)}]
+        system=cached_system(SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": cached_content(rag_section, "\n".join(lines))}]
     )
 
+
+def _category(response) -> str:
     text = response.content[0].text.strip()
     if "|" in text:
         return text.split("|")[0].strip()
     return text.split()[0] if text else "FRMC"
 
 
-def search_at(patient: PatientState, api_key: str, vectorstore=None, tavily_api_key: str = None) -> list:
-    client = Anthropic(api_key=api_key)
+def determine_vph_category(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> str:
+    response = create_message(
+        api_key, "determine_vph_category", refresh=refresh,
+        **_category_request(patient, vectorstore)
+    )
+    return _category(response)
+
+
+async def adetermine_vph_category(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> str:
+    response = await acreate_message(
+        api_key, "determine_vph_category", refresh=refresh,
+        **await asyncio.to_thread(_category_request, patient, vectorstore)
+    )
+    return _category(response)
 
+
+def _search_request(patient: PatientState, vectorstore=None) -> dict:
     rag_section = ""
     if vectorstore:
         try:
-            from rag.retriever import search, format_context
-            docs = search(
-                "fauteuil roulant indication remboursement prescription categorie",
-                k=6,
-                vectorstore=vectorstore
-            )
-            if docs:
-                rag_section = "Références réglementaires :\n" + format_context(docs)
+            from rag.retriever import get_fixed_context
+            context = get_fixed_context("aides_techniques", vectorstore)
+            if context:
+                rag_section = "Références réglementaires :\n" + context
         except Exception:
             pass
 
     categorie = patient.categorie_vph_recommandee or "à déterminer"
-    diagnostic_ergo = patient.diagnostic_ergo[:400] if patient.diagnostic_ergo else "Non disponible"
+    diagnostic_ergo = section("search_at", "diagnostic", patient.diagnostic_ergo) or "Non disponible"
 
     lines = [
         "Propose 3 aides techniques (VPH) pour ce patient.",
         "",
         "PROFIL PATIENT :",
-        patient.to_context_summary(),
+        profile(patient, "search_at"),
         "",
         "CATÉGORIE VPH ENVISAGÉE : " + categorie,
         "DIAGNOSTIC ERGO : " + diagnostic_ergo,
     ]
-    if rag_section:
-        lines.append("")
-        lines.append(rag_section)
     lines += [
         "",
-        "Pour chaque proposition, fournis un JSON avec ces champs :",
-        "- categorie : code VPH",
-        "- modele : nom commercial",
-        "- justification_clinique : 3-4 phrases",
-        "- caracteristiques_cles : liste de 4 points",
-        "- code_lpp : code LPP ou vide",
-        "- remboursement : achat/LCD/LLD",
-        "- avantages : liste de 2-3 avantages",
-        "- points_vigilance : liste de 1-2 points",
-        "",
-        "Réponds UNIQUEMENT avec un tableau JSON valide : [{...}, {...}, {...}]"
+        "Réponds avec l'outil PropositionsAT (3 propositions).",
     ]
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+    return dict(
+        model=model_for("search_at"),
         max_tokens=2000,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": "\n".join(lines)}]
+        system=cached_system(SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": cached_content(rag_section, "\n".join(lines))}]
     )
 
-    text = response.content[0].text
-    match = re.search(r'\[.*\]', text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group())
-        except json.JSONDecodeError:
-            pass
+
+def _propositions(patient: PatientState, result) -> list:
+    if result is not None:
+        return [prop.model_dump() for prop in result.propositions]
 
     return [{
-        "categorie": categorie,
+        "categorie": patient.categorie_vph_recommandee or "à déterminer",
         "modele": "À déterminer lors de l'essai",
-        "justification_clinique": text[:500],
+        "justification_clinique": "Propositions non générées : la réponse du modèle n'a pas pu être analysée.",
         "caracteristiques_cles": ["Évaluation approfondie nécessaire"],
         "code_lpp": "",
         "remboursement": "Selon durée du besoin",
         "avantages": ["À évaluer"],
         "points_vigilance": ["Essai obligatoire avec l'ergothérapeute"]
     }]
+
+
+def search_at(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    tavily_api_key: str = None,
+    refresh: bool = False,
+) -> list:
+    result = create_structured(
+        api_key, "search_at", PropositionsAT, refresh=refresh,
+        **_search_request(patient, vectorstore)
+    )
+    return _propositions(patient, result)
+
+
+async def asearch_at(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    tavily_api_key: str = None,
+    refresh: bool = False,
+) -> list:
+    result = await acreate_structured(
+        api_key, "search_at", PropositionsAT, refresh=refresh,
+        **await asyncio.to_thread(_search_request, patient, vectorstore)
+    )
+    return _propositions(patient, result)
@@ -1,12 +1,25 @@
 """
 UtopIA — Node Chat Clinique
 Génère des questions ciblées sur le profil patient et collecte les réponses.
+L'entretien est transmis en tours user / assistant, avec un préfixe cacheable.
 """
 
-import json
-import re
-from anthropic import Anthropic
+import asyncio
+import copy
+import hashlib
+import os
+from typing import Tuple
+
+from graph import jobs, scheduler
+from graph.llm import (
+    CACHE_CONTROL, acreate_message, acreate_structured,
+    cached_content, cached_system, create_message, create_structured,
+)
+from graph.prompt import profile
+from graph.routing import model_for
+from graph.schemas import ProchaineQuestion
 from graph.state import PatientState
+from utils.tokens import count_tokens
 
 SYSTEM_PROMPT = """Tu es UtopIA, un ergothérapeute expert en préconisation de fauteuils roulants (VPH).
 Tu mènes un entretien clinique structuré pour compléter l'évaluation d'un patient avant de faire tes préconisations.
@@ -21,28 +34,30 @@ Tu poses UNE question à la fois, avec éventuellement des sous-points.
 Tu utilises les réponses précédentes pour affiner les questions suivantes.
 Tu indiques quand tu as suffisamment d'informations pour faire des préconisations."""
 
+# Au-delà de ce budget (tokens estimés), les échanges les plus anciens sont résumés.
+# Les tours d'entretien passent par Claude 3 Haiku, qui ne met en cache qu'un préfixe
+# d'au moins 2048 tokens : prompt système (~185) + profil (≤ 500) + historique doit pouvoir
+# les dépasser, sans quoi le point de cache du dernier message ne serait jamais relu.
+HISTORY_TOKEN_BUDGET = int(os.environ.get("UTOPIA_CHAT_HISTORY_BUDGET", "3000"))
+# Derniers messages toujours transmis tels quels
+KEEP_RECENT_MESSAGES = 4
 
-def generate_first_question(patient: PatientState, api_key: str, vectorstore=None) -> str:
-    """Génère la première question ciblée selon le profil."""
-    client = Anthropic(api_key=api_key)
 
+def _first_question_request(patient: PatientState, vectorstore=None) -> dict:
     rag_section = ""
     if vectorstore:
         try:
-            from rag.retriever import search, format_context
-            docs = search(
-                "evaluation capacites fonctionnelles fauteuil roulant propulsion transfert",
-                k=3, vectorstore=vectorstore
-            )
-            if docs:
-                rag_section = "Références cliniques :\n" + format_context(docs)
+            from rag.retriever import get_fixed_context
+            context = get_fixed_context("premiere_question", vectorstore)
+            if context:
+                rag_section = "Références cliniques :\n" + context
         except Exception:
             pass
 
     lines = [
         "Voici le profil d'un patient pour lequel je dois compléter l'évaluation avant de préconiser un VPH.",
         "",
-        patient.to_context_summary(),
+        profile(patient, "generate_first_question"),
         "",
         "Sur la base de ce profil, pose la PREMIÈRE question clinique la plus importante pour orienter",
         "le choix du type de fauteuil (manuel, électrique, avec assistance...).",
@@ -55,89 +70,297 @@ def generate_first_question(patient: PatientState, api_key: str, vectorstore=Non
         "Commence directement par la question, avec une courte introduction contextuelle.",
         "Utilise des emojis 👉 pour les sous-points.",
     ]
-    if rag_section:
-        lines.append("")
-        lines.append(rag_section)
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+    return dict(
+        model=model_for("generate_first_question"),
         max_tokens=600,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": "\n".join(lines)}]
+        system=cached_system(SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": cached_content(rag_section, "\n".join(lines))}]
+    )
+
+
+def generate_first_question(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> str:
+    """Génère la première question ciblée selon le profil."""
+    response = create_message(
+        api_key, "generate_first_question", refresh=refresh,
+        **_first_question_request(patient, vectorstore)
     )
     return response.content[0].text
 
 
-def generate_next_question(
+async def agenerate_first_question(
     patient: PatientState,
     api_key: str,
-    conversation_history: list,
-    vectorstore=None
-) -> dict:
+    vectorstore=None,
+    refresh: bool = False,
+) -> str:
+    response = await acreate_message(
+        api_key, "generate_first_question", refresh=refresh,
+        **await asyncio.to_thread(_first_question_request, patient, vectorstore)
+    )
+    return response.content[0].text
+
+
+PREFETCH_PREFIX = "premiere_question:"
+
+
+def first_question_key(patient: PatientState, api_key: str, session_id: str, vectorstore=None) -> str:
     """
-    Génère la question suivante basée sur l'historique de conversation.
-    Retourne : {"question": "...", "terminé": bool, "synthese": "..."}
+    Clé de la génération anticipée : propre à la session Streamlit et à la clé API
+    (empreinte, jamais la clé elle-même), puis entrées de generate_first_question
+    (profil patient + version de l'index).
+    """
+    version = ""
+    if vectorstore:
+        try:
+            from rag.retriever import index_version
+            version = index_version(vectorstore)
+        except Exception:
+            pass
+    key_hash = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    raw = "\n".join([key_hash, version, patient.to_context_summary()])
+    return jobs.session_key(session_id, PREFETCH_PREFIX + hashlib.sha256(raw.encode("utf-8")).hexdigest())
+
+
+def _prefetched_first_question(patient: PatientState, api_key: str, vectorstore=None) -> str:
+    # Génération spéculative : elle passe après les tours d'entretien et les étapes demandées
+    with scheduler.priority(scheduler.BULK):
+        return generate_first_question(patient, api_key, vectorstore)
+
+
+def prefetch_first_question(patient: PatientState, api_key: str, session_id: str, vectorstore=None) -> None:
     """
-    client = Anthropic(api_key=api_key)
+    Lance la génération de la première question en arrière-plan, dès que le profil est enregistré.
+    Le patient est copié : les modifications ultérieures de la page n'affectent pas la tâche.
+    Une génération anticipée précédente de la session (profil modifié depuis) est annulée.
+    """
+    key = first_question_key(patient, api_key, session_id, vectorstore)
+    jobs.cancel_prefix(jobs.session_key(session_id, PREFETCH_PREFIX), keep=key)
+    jobs.submit(key, _prefetched_first_question, copy.deepcopy(patient), api_key, vectorstore)
+
+
+def get_first_question(patient: PatientState, api_key: str, session_id: str, vectorstore=None) -> str:
+    """
+    Première question : reprend la génération anticipée de cette session si elle correspond
+    au profil et à la clé API actuels (en attendant sa fin si besoin), sinon la génère directement.
+    """
+    job = jobs.pop(first_question_key(patient, api_key, session_id, vectorstore))
+    if job is not None:
+        try:
+            return job.result()
+        except Exception:
+            pass
+    return generate_first_question(patient, api_key, vectorstore)
+
 
-    # Construire l'historique formaté
+def _transcript(conversation_history: list) -> str:
     history_str = ""
     for msg in conversation_history:
         role = "UtopIA" if msg["role"] == "assistant" else "Ergothérapeute"
         history_str += role + " : " + msg["content"] + "\n\n"
+    return history_str
+
+
+def _split_history(conversation_history: list) -> Tuple[list, list]:
+    """
+    (échanges à résumer, échanges transmis tels quels). Rien n'est résumé sous HISTORY_TOKEN_BUDGET ;
+    au-delà, la coupure se fait entre deux paires question / réponse (indice pair), à la première
+    des frontières où les échanges anciens franchissent un multiple de HISTORY_TOKEN_BUDGET / 2
+    qui laisse la suite dans le budget. Ces frontières ne dépendent que du début de l'entretien :
+    la tranche résumée (mémoïsée) change le plus souvent tous les demi-budgets de nouveaux échanges.
+    Les KEEP_RECENT_MESSAGES derniers messages ne sont jamais résumés.
+    """
+    history = list(conversation_history)
+    sizes = [count_tokens(_transcript([msg])) for msg in history]
+    total = sum(sizes)
+    if total <= HISTORY_TOKEN_BUDGET:
+        return [], history
+    step = max(HISTORY_TOKEN_BUDGET // 2, 1)
+    latest = max(0, len(history) - KEEP_RECENT_MESSAGES) // 2 * 2
+    cut, older_tokens, boundary = 0, 0, step
+    for i in range(0, latest, 2):
+        older_tokens += sizes[i] + sizes[i + 1]
+        if older_tokens >= boundary:
+            cut = i + 2
+            boundary = (older_tokens // step + 1) * step
+            if total - older_tokens <= HISTORY_TOKEN_BUDGET:
+                break
+    # Aucune frontière ne suffit (échanges récents très longs) : première coupure paire qui tient
+    while cut < latest and total - sum(sizes[:cut]) > HISTORY_TOKEN_BUDGET:
+        cut += 2
+    return history[:cut], history[cut:]
+
 
+def _summary_request(older: list) -> dict:
     lines = [
-        "Profil patient :",
-        patient.to_context_summary(),
+        "Résume ces premiers échanges d'un entretien clinique en conservant toutes les",
+        "informations utiles à la préconisation (capacités, posture, transferts, environnement, activités).",
         "",
-        "Entretien clinique réalisé jusqu'ici :",
-        history_str,
+        _transcript(older),
+        "Réponds en 5-8 phrases, sans introduction.",
+    ]
+    return dict(
+        model=model_for("summarize_history"),
+        max_tokens=500,
+        system=cached_system(SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": "\n".join(lines)}]
+    )
+
+
+def _summarize_history(api_key: str, older: list, refresh: bool = False) -> str:
+    """Résumé des échanges les plus anciens (mémoïsé : calculé une fois par tranche)."""
+    if not older:
+        return ""
+    response = create_message(
+        api_key, "summarize_history", refresh=refresh, **_summary_request(older)
+    )
+    return response.content[0].text
+
+
+async def _asummarize_history(api_key: str, older: list, refresh: bool = False) -> str:
+    if not older:
+        return ""
+    response = await acreate_message(
+        api_key, "summarize_history", refresh=refresh, **_summary_request(older)
+    )
+    return response.content[0].text
+
+
+def _conversation_messages(patient: PatientState, recent: list, summary: str, instruction: str) -> list:
+    """
+    L'entretien sous forme de vrais tours user / assistant :
+    - premier message : le profil patient, bloc cacheable identique à chaque tour ;
+    - les échanges anciens éventuels sont remplacés par leur résumé (cf. _split_history) ;
+    - le dernier message de l'historique clôt le préfixe cacheable, relu depuis le cache au tour suivant ;
+    - la consigne du tour est ajoutée après ce préfixe.
+    """
+    opening = [{
+        "type": "text",
+        "text": "Profil patient :\n" + profile(patient, "generate_next_question") + "\n\nL'entretien clinique commence ci-dessous.",
+        "cache_control": CACHE_CONTROL,
+    }]
+    if summary:
+        opening.append({"type": "text", "text": "Résumé des échanges précédents :\n" + summary})
+
+    messages = [{"role": "user", "content": opening}]
+    for msg in recent:
+        block = {"type": "text", "text": msg["content"]}
+        if messages[-1]["role"] == msg["role"]:
+            messages[-1]["content"].append(block)
+        else:
+            messages.append({"role": msg["role"], "content": [block]})
+    messages[-1]["content"][-1]["cache_control"] = CACHE_CONTROL
+
+    consigne = {"type": "text", "text": instruction}
+    if messages[-1]["role"] == "user":
+        messages[-1]["content"].append(consigne)
+    else:
+        messages.append({"role": "user", "content": [consigne]})
+    return messages
+
+
+def _nb_exchanges(conversation_history: list) -> int:
+    return len([m for m in conversation_history if m["role"] == "assistant"])
+
+
+def _next_question_request(patient: PatientState, conversation_history: list, recent: list, summary: str) -> dict:
+    lines = [
+        "(Consigne pour UtopIA — " + str(_nb_exchanges(conversation_history)) + " question(s) déjà posée(s).)",
         "Sur la base des réponses obtenues :",
         "1. As-tu suffisamment d'informations pour faire des préconisations VPH précises ?",
-        "2. Si oui, réponds en JSON : {\"termine\": true, \"synthese\": \"résumé des points clés en 3-4 phrases\"}",
-        "3. Si non, pose la prochaine question clinique la plus importante.",
-        "   Réponds en JSON : {\"termine\": false, \"question\": \"ta question avec sous-points\"}",
+        "2. Si oui, termine l'entretien et rédige la synthèse clinique structurée en 4-5 phrases qui résume :",
+        "   les capacités de propulsion et d'endurance, le contrôle postural, les capacités de transfert,",
+        "   les contraintes environnementales clés et les éléments déterminants pour le choix du VPH.",
+        "   Cette synthèse sera intégrée directement dans le dossier patient.",
+        "3. Si non, pose la prochaine question clinique la plus importante, avec sous-points.",
         "",
         "Maximum 5 questions au total. Si on a déjà 4 échanges ou plus, conclure obligatoirement.",
-        "Réponds UNIQUEMENT en JSON valide.",
+        "Réponds avec l'outil ProchaineQuestion.",
     ]
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
-        max_tokens=600,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": "\n".join(lines)}]
+    return dict(
+        model=model_for("generate_next_question"),
+        max_tokens=900,
+        system=cached_system(SYSTEM_PROMPT),
+        messages=_conversation_messages(patient, recent, summary, "\n".join(lines)),
     )
 
-    text = response.content[0].text
-    match = re.search(r'\{.*\}', text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group())
-        except Exception:
-            pass
+
+# Question de relance quand la réponse du modèle n'est pas exploitable
+FALLBACK_QUESTION = "Pouvez-vous préciser les éléments du profil qui vous semblent encore incomplets ?"
+
+
+def generate_next_question(
+    patient: PatientState,
+    api_key: str,
+    conversation_history: list,
+    vectorstore=None,
+    refresh: bool = False,
+) -> dict:
+    """
+    Génère la question suivante basée sur l'historique de conversation.
+    En fin d'entretien, la synthèse destinée au dossier est produite dans le même appel.
+    Retourne : {"question": "...", "termine": bool, "synthese": "..."}
+    """
+    older, recent = _split_history(conversation_history)
+    summary = _summarize_history(api_key, older, refresh=refresh)
+    result = create_structured(
+        api_key, "generate_next_question", ProchaineQuestion, refresh=refresh,
+        **_next_question_request(patient, conversation_history, recent, summary)
+    )
+
+    if result is not None and result.termine and not result.synthese.strip():
+        # Fin d'entretien sans synthèse exploitable : appel dédié, en secours seulement
+        result.synthese = build_chat_synthesis(patient, api_key, conversation_history, refresh=refresh)
+    if result is not None and (result.termine or result.question):
+        return result.model_dump()
 
     # Fallback
-    nb_exchanges = len([m for m in conversation_history if m["role"] == "assistant"])
-    if nb_exchanges >= 4:
-        return {"termine": True, "synthese": "Informations suffisantes collectées pour la préconisation."}
-    return {"termine": False, "question": text}
+    if _nb_exchanges(conversation_history) >= 4:
+        return {
+            "termine": True,
+            "synthese": build_chat_synthesis(patient, api_key, conversation_history, refresh=refresh),
+        }
+    return {"termine": False, "question": FALLBACK_QUESTION}
 
 
-def build_chat_synthesis(patient: PatientState, api_key: str, conversation_history: list) -> str:
-    """Synthèse finale de l'entretien pour enrichir le PatientState."""
-    client = Anthropic(api_key=api_key)
+async def agenerate_next_question(
+    patient: PatientState,
+    api_key: str,
+    conversation_history: list,
+    vectorstore=None,
+    refresh: bool = False,
+) -> dict:
+    older, recent = _split_history(conversation_history)
+    summary = await _asummarize_history(api_key, older, refresh=refresh)
+    result = await acreate_structured(
+        api_key, "generate_next_question", ProchaineQuestion, refresh=refresh,
+        **_next_question_request(patient, conversation_history, recent, summary)
+    )
 
-    history_str = ""
-    for msg in conversation_history:
-        role = "UtopIA" if msg["role"] == "assistant" else "Ergothérapeute"
-        history_str += role + " : " + msg["content"] + "\n\n"
+    if result is not None and result.termine and not result.synthese.strip():
+        result.synthese = await abuild_chat_synthesis(patient, api_key, conversation_history, refresh=refresh)
+    if result is not None and (result.termine or result.question):
+        return result.model_dump()
+
+    if _nb_exchanges(conversation_history) >= 4:
+        return {
+            "termine": True,
+            "synthese": await abuild_chat_synthesis(patient, api_key, conversation_history, refresh=refresh),
+        }
+    return {"termine": False, "question": FALLBACK_QUESTION}
 
+
+def _synthesis_request(patient: PatientState, recent: list, summary: str) -> dict:
     lines = [
-        "Sur la base de cet entretien clinique complémentaire :",
-        "",
-        history_str,
-        "Rédige une synthèse clinique structurée en 4-5 phrases qui résume :",
+        "(Consigne pour UtopIA — fin de l'entretien.)",
+        "Sur la base de cet entretien clinique complémentaire,",
+        "rédige une synthèse clinique structurée en 4-5 phrases qui résume :",
         "- Les capacités de propulsion et d'endurance",
         "- Le contrôle postural",
         "- Les capacités de transfert",
@@ -147,10 +370,43 @@ def build_chat_synthesis(patient: PatientState, api_key: str, conversation_histo
         "Cette synthèse sera intégrée directement dans le dossier patient.",
     ]
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+    return dict(
+        model=model_for("build_chat_synthesis"),
         max_tokens=500,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": "\n".join(lines)}]
+        system=cached_system(SYSTEM_PROMPT),
+        messages=_conversation_messages(patient, recent, summary, "\n".join(lines)),
+    )
+
+
+def build_chat_synthesis(
+    patient: PatientState,
+    api_key: str,
+    conversation_history: list,
+    refresh: bool = False,
+) -> str:
+    """
+    Synthèse finale de l'entretien pour enrichir le PatientState.
+    Normalement produite par generate_next_question ; appel de secours seulement.
+    """
+    older, recent = _split_history(conversation_history)
+    summary = _summarize_history(api_key, older, refresh=refresh)
+    response = create_message(
+        api_key, "build_chat_synthesis", refresh=refresh,
+        **_synthesis_request(patient, recent, summary)
+    )
+    return response.content[0].text
+
+
+async def abuild_chat_synthesis(
+    patient: PatientState,
+    api_key: str,
+    conversation_history: list,
+    refresh: bool = False,
+) -> str:
+    older, recent = _split_history(conversation_history)
+    summary = await _asummarize_history(api_key, older, refresh=refresh)
+    response = await acreate_message(
+        api_key, "build_chat_synthesis", refresh=refresh,
+        **_synthesis_request(patient, recent, summary)
     )
     return response.content[0].text
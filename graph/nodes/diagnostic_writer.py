@@ -2,7 +2,14 @@
 UtopIA — Node 2 : Rédaction du diagnostic ergothérapique
 """
 
-from anthropic import Anthropic
+import asyncio
+from typing import AsyncIterator, Iterator
+
+from graph.llm import (
+    acreate_message, astream_message, cached_content, cached_system, create_message, stream_message,
+)
+from graph.prompt import profile
+from graph.routing import model_for
 from graph.state import PatientState
 
 SYSTEM_PROMPT = """Tu es UtopIA, ergothérapeute expert spécialisé en préconisation VPH.
@@ -11,20 +18,14 @@ Ton style est clinique, précis, orienté sur les besoins fonctionnels et occupa
 Tu utilises le vocabulaire professionnel de l'ergothérapie française."""
 
 
-def write_diagnostic(patient: PatientState, api_key: str, vectorstore=None) -> str:
-    client = Anthropic(api_key=api_key)
-
+def _build_prompt(patient: PatientState, vectorstore=None) -> list:
     rag_section = ""
     if vectorstore:
         try:
-            from rag.retriever import search, format_context
-            docs = search(
-                "diagnostic evaluation besoins positionnement fauteuil roulant",
-                k=4,
-                vectorstore=vectorstore
-            )
-            if docs:
-                rag_section = "Références cliniques :\n" + format_context(docs)
+            from rag.retriever import get_fixed_context
+            context = get_fixed_context("diagnostic", vectorstore)
+            if context:
+                rag_section = "Références cliniques :\n" + context
         except Exception:
             pass
 
@@ -48,7 +49,7 @@ def write_diagnostic(patient: PatientState, api_key: str, vectorstore=None) -> s
         "Rédige un diagnostic ergothérapique complet pour ce patient, en utilisant le modèle " + modele + ".",
         "",
         "PROFIL PATIENT :",
-        patient.to_context_summary(),
+        profile(patient, "write_diagnostic"),
     ]
     if mesures:
         lines.append("")
@@ -57,9 +58,6 @@ def write_diagnostic(patient: PatientState, api_key: str, vectorstore=None) -> s
     if patient.justification_modele:
         lines.append("")
         lines.append("Justification du modèle : " + patient.justification_modele)
-    if rag_section:
-        lines.append("")
-        lines.append(rag_section)
 
     lines += [
         "",
@@ -72,13 +70,67 @@ def write_diagnostic(patient: PatientState, api_key: str, vectorstore=None) -> s
         "Sois précis, clinique. Maximum 500 mots.",
     ]
 
-    user_prompt = "\n".join(lines)
+    return cached_content(rag_section, "\n".join(lines))
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+
+def _request(patient: PatientState, vectorstore=None) -> dict:
+    return dict(
+        model=model_for("write_diagnostic"),
         max_tokens=1200,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": user_prompt}]
+        system=cached_system(SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": _build_prompt(patient, vectorstore)}]
+    )
+
+
+def write_diagnostic(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> str:
+    response = create_message(
+        api_key, "write_diagnostic", refresh=refresh,
+        **_request(patient, vectorstore)
     )
 
     return response.content[0].text
+
+
+def stream_diagnostic(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> Iterator[str]:
+    """Variante streamée de write_diagnostic : produit le texte au fil de la génération."""
+    yield from stream_message(
+        api_key, "write_diagnostic", refresh=refresh,
+        **_request(patient, vectorstore)
+    )
+
+
+async def awrite_diagnostic(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> str:
+    response = await acreate_message(
+        api_key, "write_diagnostic", refresh=refresh,
+        **await asyncio.to_thread(_request, patient, vectorstore)
+    )
+
+    return response.content[0].text
+
+
+async def astream_diagnostic(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> AsyncIterator[str]:
+    async for text in astream_message(
+        api_key, "write_diagnostic", refresh=refresh,
+        **await asyncio.to_thread(_request, patient, vectorstore)
+    ):
+        yield text
@@ -2,9 +2,11 @@
 UtopIA — Node 1 : Sélection du modèle conceptuel
 """
 
-import json
-import re
-from anthropic import Anthropic
+import asyncio
+from graph.llm import acreate_structured, cached_content, cached_system, create_structured
+from graph.prompt import profile
+from graph.routing import model_for
+from graph.schemas import ModeleConceptuel
 from graph.state import PatientState
 
 SYSTEM_PROMPT = """Tu es UtopIA, un assistant expert en ergothérapie clinique, spécialisé dans
@@ -19,23 +21,17 @@ Tu maîtrises parfaitement les modèles conceptuels en ergothérapie :
 Tu réponds en français, de façon structurée et professionnelle."""
 
 
-def select_model_conceptuel(patient: PatientState, api_key: str, vectorstore=None) -> dict:
-    client = Anthropic(api_key=api_key)
-
-    profil = patient.to_context_summary()
+def _request(patient: PatientState, vectorstore=None) -> dict:
+    profil = profile(patient, "select_model_conceptuel")
 
     # Contexte RAG si disponible
     rag_section = ""
     if vectorstore:
         try:
-            from rag.retriever import search, format_context
-            docs = search(
-                "modele conceptuel ergotherapie evaluation besoins",
-                k=3,
-                vectorstore=vectorstore
-            )
-            if docs:
-                rag_section = "Contexte documentaire :\n" + format_context(docs)
+            from rag.retriever import get_fixed_context
+            context = get_fixed_context("modele_conceptuel", vectorstore)
+            if context:
+                rag_section = "Contexte documentaire :\n" + context
         except Exception:
             pass
 
@@ -44,36 +40,29 @@ def select_model_conceptuel(patient: PatientState, api_key: str, vectorstore=Non
         "",
         profil,
     ]
-    if rag_section:
-        lines.append("")
-        lines.append(rag_section)
 
     lines += [
         "",
-        "Analyse ce profil et réponds en JSON strict avec ce format :",
-        '{"modele": "NOM", "justification": "...", "axes_evaluation": ["axe1", "axe2", "axe3", "axe4"]}',
+        "Analyse ce profil et réponds avec l'outil ModeleConceptuel.",
     ]
 
     user_prompt = "\n".join(lines)
 
-    response = client.messages.create(
-        model="claude-3-haiku-20240307",
+    return dict(
+        model=model_for("select_model_conceptuel"),
         max_tokens=800,
-        system=SYSTEM_PROMPT,
-        messages=[{"role": "user", "content": user_prompt}]
+        system=cached_system(SYSTEM_PROMPT),
+        messages=[{"role": "user", "content": cached_content(rag_section, user_prompt)}]
     )
 
-    text = response.content[0].text
-    match = re.search(r'\{.*\}', text, re.DOTALL)
-    if match:
-        try:
-            return json.loads(match.group())
-        except json.JSONDecodeError:
-            pass
+
+def _result(result) -> dict:
+    if result is not None:
+        return result.model_dump()
 
     return {
         "modele": "MCREO",
-        "justification": text,
+        "justification": "Modèle par défaut : la réponse du modèle n'a pas pu être analysée.",
         "axes_evaluation": [
             "Capacités fonctionnelles",
             "Environnement",
@@ -81,3 +70,29 @@ def select_model_conceptuel(patient: PatientState, api_key: str, vectorstore=Non
             "Participation sociale"
         ]
     }
+
+
+def select_model_conceptuel(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> dict:
+    result = create_structured(
+        api_key, "select_model_conceptuel", ModeleConceptuel, refresh=refresh,
+        **_request(patient, vectorstore)
+    )
+    return _result(result)
+
+
+async def aselect_model_conceptuel(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    refresh: bool = False,
+) -> dict:
+    result = await acreate_structured(
+        api_key, "select_model_conceptuel", ModeleConceptuel, refresh=refresh,
+        **await asyncio.to_thread(_request, patient, vectorstore)
+    )
+    return _result(result)
@@ -0,0 +1,135 @@
+"""
+UtopIA — Orchestration de la préconisation
+Modèle conceptuel → diagnostic ergo → catégorie VPH → recherche des AT.
+La recherche des AT dépend de la catégorie : elle est relancée quand celle-ci change,
+y compris quand l'ergothérapeute la choisit à la main.
+"""
+
+from typing import Callable, Optional
+
+from graph.engine import PROFIL_FIELDS, Graph, Node
+from graph.state import PatientState
+from graph.nodes.model_selector import select_model_conceptuel
+from graph.nodes.diagnostic_writer import write_diagnostic
+from graph.nodes.at_researcher import search_at, determine_vph_category
+
+MESURES_FIELDS = (
+    "largeur_bassin", "longueur_cuisses", "longueur_creux_poplite_pied",
+    "hauteur_omoplate", "largeur_tronc", "poids",
+)
+
+
+def _run_modele(patient: PatientState, api_key: str, vectorstore, refresh: bool = False) -> dict:
+    result = select_model_conceptuel(patient, api_key, vectorstore, refresh=refresh)
+    return {
+        "modele_conceptuel_choisi": result.get("modele", "MCREO"),
+        "justification_modele": result.get("justification", ""),
+        "axes_evaluation": result.get("axes_evaluation", []),
+    }
+
+
+def _run_diagnostic(patient: PatientState, api_key: str, vectorstore, refresh: bool = False) -> dict:
+    return {"diagnostic_ergo": write_diagnostic(patient, api_key, vectorstore, refresh=refresh)}
+
+
+def _run_categorie(patient: PatientState, api_key: str, vectorstore, refresh: bool = False) -> dict:
+    categorie = determine_vph_category(patient, api_key, vectorstore, refresh=refresh)
+    return {"categorie_vph_recommandee": categorie}
+
+
+def _run_aides_techniques(patient: PatientState, api_key: str, vectorstore, refresh: bool = False) -> dict:
+    return {"propositions_at": search_at(patient, api_key, vectorstore, refresh=refresh)}
+
+
+PRECONISATION_GRAPH = Graph([
+    Node(
+        "modele_conceptuel", _run_modele,
+        inputs=PROFIL_FIELDS,
+        outputs=("modele_conceptuel_choisi", "justification_modele"),
+    ),
+    Node(
+        "diagnostic", _run_diagnostic,
+        inputs=PROFIL_FIELDS + MESURES_FIELDS + ("modele_conceptuel_choisi", "justification_modele"),
+        outputs=("diagnostic_ergo",),
+    ),
+    Node(
+        "categorie_vph", _run_categorie,
+        inputs=PROFIL_FIELDS + ("diagnostic_ergo",),
+        outputs=("categorie_vph_recommandee",),
+    ),
+    # search_at oriente sa recherche sur la catégorie : elle fait partie de ses entrées
+    Node(
+        "aides_techniques", _run_aides_techniques,
+        inputs=PROFIL_FIELDS + ("diagnostic_ergo", "categorie_vph_recommandee"),
+        outputs=("propositions_at",),
+    ),
+])
+
+
+# Champs du PatientState écrits par le graphe
+OUTPUT_FIELDS = tuple(out for node in PRECONISATION_GRAPH.nodes.values() for out in node.outputs)
+
+# Entrée du cache de l'appelant : dernière catégorie écrite par le graphe. Une catégorie
+# différente a été choisie sur la page et n'est jamais écrasée.
+GRAPH_CATEGORY_KEY = "categorie_vph/valeur"
+
+
+def run_preconisation(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    on_step: Optional[Callable[[str], None]] = None,
+    cache: Optional[dict] = None,
+    refresh: bool = False,
+) -> dict:
+    """
+    Enchaîne toute la préconisation et met à jour `patient` en place.
+    Avec `cache` (conservé par l'appelant), les étapes dont les entrées n'ont pas
+    changé depuis la dernière exécution sont sautées ; `refresh=True` régénère tout
+    (réponses LLM mémoïsées comprises).
+    La catégorie VPH n'est pas redétectée si elle a été choisie manuellement
+    (différente de la dernière valeur produite par le graphe, cf. GRAPH_CATEGORY_KEY).
+    Retourne {"axes_evaluation": [...], "durees": {étape: secondes}}.
+    """
+    cache = cache if cache is not None else {}
+    labels = {
+        "modele_conceptuel": "Analyse du profil patient...",
+        "diagnostic": "Rédaction du diagnostic ergothérapique...",
+        "categorie_vph": "Détection de la catégorie VPH...",
+        "aides_techniques": "Recherche des aides techniques...",
+    }
+
+    def on_event(name: str, event: str) -> None:
+        if on_step and event == "start":
+            on_step(labels.get(name, name))
+
+    # Catégorie saisie à la main (autre que la dernière produite par le graphe) : on la conserve
+    exclude = []
+    if patient.categorie_vph_recommandee and patient.categorie_vph_recommandee != cache.get(GRAPH_CATEGORY_KEY):
+        exclude.append("categorie_vph")
+
+    report = PRECONISATION_GRAPH.run(
+        patient, api_key, vectorstore, cache=cache, refresh=refresh, exclude=exclude, on_event=on_event
+    )
+    if "categorie_vph" in report.ran:
+        cache[GRAPH_CATEGORY_KEY] = patient.categorie_vph_recommandee
+    axes = report.artifacts.get("modele_conceptuel", {}).get("axes_evaluation")
+    return {"axes_evaluation": axes, "durees": report.durations}
+
+
+def run_preconisation_detached(
+    patient: PatientState,
+    api_key: str,
+    vectorstore=None,
+    on_step: Optional[Callable[[str], None]] = None,
+    cache: Optional[dict] = None,
+    refresh: bool = False,
+) -> dict:
+    """
+    Variante pour une tâche de fond (cf. graph.jobs) : `patient` est une copie de travail
+    (la page peut modifier l'original pendant l'exécution). Retourne en plus les champs
+    produits ({"outputs": {champ: valeur}}), que l'appelant reporte sur son PatientState.
+    """
+    result = run_preconisation(patient, api_key, vectorstore, on_step=on_step, cache=cache, refresh=refresh)
+    result["outputs"] = {name: getattr(patient, name) for name in OUTPUT_FIELDS}
+    return result
@@ -0,0 +1,46 @@
+"""
+UtopIA — Budgets de prompt
+Chaque node dispose d'un budget de tokens par section (profil, diagnostic, essais…).
+Une section trop longue est réduite par phrases entières, en gardant d'abord celles
+qui touchent aux critères utiles au node (FOCUS) ; le contexte RAG a son propre budget
+(UTOPIA_RAG_TOKEN_BUDGET, cf. rag.retriever.format_context).
+"""
+
+import os
+
+from graph.state import PatientState
+from utils.tokens import fit, fit_lines
+
+PROFILE_BUDGET = int(os.environ.get("UTOPIA_PROFILE_TOKEN_BUDGET", "500"))
+
+# node → section → tokens
+BUDGETS = {
+    "search_at": {"diagnostic": 120},
+    "write_argumentaire": {"diagnostic": 180, "observations": 150, "motifs_rejet": 100, "reglages": 100},
+}
+
+# Mots-clés de pertinence par node : phrases gardées en priorité quand une section déborde
+FOCUS = {
+    "select_model_conceptuel": "occupation activités participation environnement habitudes rôles motivation",
+    "write_diagnostic": "capacités limitations activités participation environnement posture transferts",
+    "determine_vph_category": "propulsion marche endurance posture transferts poids bassin extérieur intérieur",
+    "search_at": "propulsion endurance posture transferts poids bassin extérieur terrain coussin dossier",
+    "write_argumentaire": "fauteuil propulsion posture transferts autonomie participation essai réglages rejet",
+}
+
+
+def budget(node: str, section: str) -> int:
+    if section == "profil":
+        return BUDGETS.get(node, {}).get("profil", PROFILE_BUDGET)
+    return BUDGETS[node][section]
+
+
+def profile(patient: PatientState, node: str) -> str:
+    """Résumé du profil tenu dans le budget du node : toutes les lignes, les plus longues réduites."""
+    lines = patient.to_context_summary().split("\n")
+    return "\n".join(fit_lines(lines, budget(node, "profil"), FOCUS.get(node, "")))
+
+
+def section(node: str, name: str, text: str) -> str:
+    """Texte libre d'une section réduit à son budget."""
+    return fit(text, budget(node, name), FOCUS.get(node, "")) if text else text
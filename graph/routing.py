@@ -0,0 +1,47 @@
+"""
+UtopIA — Routage des modèles
+Chaque node choisit son modèle par niveau (tier) selon le mode d'appel :
+- "draft" : mode par défaut de tous les nodes — niveau rapide pour les sorties courtes
+  et les tours d'entretien, intermédiaire pour les analyses de l'étape Préconisation
+  et la synthèse de fin d'entretien ;
+- "final" : passe de qualité, déclenchée à la demande (ex. version finale de l'argumentaire).
+Les latences par node et par modèle (p50 / p95, cf. graph.telemetry) servent à ajuster la table.
+"""
+
+import os
+
+FAST = "fast"
+BALANCED = "balanced"
+QUALITY = "quality"
+
+TIERS = {
+    FAST: os.environ.get("UTOPIA_MODEL_FAST", "claude-3-haiku-20240307"),
+    BALANCED: os.environ.get("UTOPIA_MODEL_BALANCED", "claude-sonnet-4-5"),
+    QUALITY: os.environ.get("UTOPIA_MODEL_QUALITY", "claude-opus-4-5"),
+}
+
+DRAFT = "draft"
+FINAL = "final"
+
+# (node, mode) → tier ; un mode absent de la table retombe sur le brouillon du node
+ROUTES = {
+    ("select_model_conceptuel", DRAFT): BALANCED,
+    ("write_diagnostic", DRAFT): BALANCED,
+    ("determine_vph_category", DRAFT): FAST,
+    ("determine_vph_category", FINAL): FAST,  # 200 tokens de sortie : toujours le plus rapide
+    ("search_at", DRAFT): BALANCED,
+    ("generate_first_question", DRAFT): FAST,
+    ("summarize_history", DRAFT): FAST,
+    ("generate_next_question", DRAFT): FAST,
+    ("build_chat_synthesis", DRAFT): BALANCED,  # une fois par entretien, tout l'historique
+    ("write_argumentaire", DRAFT): FAST,
+    ("write_argumentaire", FINAL): QUALITY,
+    ("generate_cpam_summary", DRAFT): FAST,
+}
+
+
+def model_for(node: str, mode: str = DRAFT) -> str:
+    """Modèle à utiliser pour ce node dans ce mode."""
+    tier = ROUTES.get((node, mode)) or ROUTES.get((node, DRAFT), FAST)
+    return TIERS[tier]
+
@@ -0,0 +1,271 @@
+"""
+UtopIA — Ordonnanceur des appels LLM
+Tous les appels Anthropic des nodes passent par submit / asubmit (cf. graph.llm) :
+- budget de tokens par minute et par clé API (seau de jetons), réservé avant l'appel
+  puis ajusté sur l'usage réel ;
+- file de priorité : les tours d'entretien passent devant les générations longues ;
+- nouvelles tentatives sur surcharge (429, 529, 5xx, coupure réseau) avec backoff
+  exponentiel à jitter, en respectant l'en-tête retry-after.
+Le client Anthropic est créé avec max_retries=0 : les reprises sont faites ici.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Iterator, Optional, TypeVar
+
+import anthropic
+
+from utils.tokens import request_tokens
+
+TOKENS_PER_MINUTE = int(os.environ.get("UTOPIA_LLM_TPM", "40000"))  # 0 = pas de limite
+MAX_RETRIES = int(os.environ.get("UTOPIA_LLM_MAX_RETRIES", "4"))
+BACKOFF_BASE = float(os.environ.get("UTOPIA_LLM_BACKOFF_BASE", "1.0"))
+BACKOFF_MAX = float(os.environ.get("UTOPIA_LLM_BACKOFF_MAX", "30"))
+
+# Priorités (plus petit = servi en premier)
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+NODE_PRIORITY = {
+    "generate_first_question": INTERACTIVE,
+    "generate_next_question": INTERACTIVE,
+    "build_chat_synthesis": INTERACTIVE,
+    "summarize_history": INTERACTIVE,
+    "write_argumentaire": BULK,
+}
+
+# Priorité imposée par l'appelant (ex. génération spéculative), prioritaire sur NODE_PRIORITY
+_PRIORITY: ContextVar[Optional[int]] = ContextVar("utopia_llm_priority", default=None)
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """
+    Seau de jetons rechargé en continu à `tokens_per_minute`.
+    Seul le premier demandeur de la file (priorité, puis ordre d'arrivée) peut se servir :
+    une génération longue en attente ne passe pas devant un tour d'entretien arrivé après elle.
+    """
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = float(tokens_per_minute)
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._waiting = []
+        self._counter = itertools.count()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def enqueue(self, priority: int) -> tuple:
+        entry = (priority, next(self._counter))
+        with self._lock:
+            heapq.heappush(self._waiting, entry)
+        return entry
+
+    def leave(self, entry: tuple) -> None:
+        with self._lock:
+            if entry in self._waiting:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+
+    def try_acquire(self, entry: tuple, tokens: float) -> float:
+        """Réserve `tokens` si c'est le tour de `entry` ; sinon retourne le délai d'attente conseillé."""
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill()
+            if self._waiting and self._waiting[0] == entry and self.available >= tokens:
+                heapq.heappop(self._waiting)
+                self.available -= tokens
+                return 0.0
+            missing = max(tokens - self.available, 0.0)
+            return max(missing * 60 / self.capacity, 0.05)
+
+    def settle(self, reserved: float, used: float) -> None:
+        """Rend (ou reprend) l'écart entre la réservation et l'usage réel."""
+        with self._lock:
+            self.available = min(self.capacity, self.available + min(reserved, self.capacity) - used)
+
+    def drain(self) -> None:
+        """Après un 429 : plus rien n'est envoyé avant que le seau se soit rechargé."""
+        with self._lock:
+            self._refill()
+            self.available = min(self.available, 0.0)
+
+
+_LOCK = threading.Lock()
+_BUCKETS: Dict[str, TokenBucket] = {}
+
+
+def _bucket(api_key: str) -> Optional[TokenBucket]:
+    if TOKENS_PER_MINUTE <= 0:
+        return None
+    with _LOCK:
+        bucket = _BUCKETS.get(api_key)
+        if bucket is None:
+            bucket = _BUCKETS[api_key] = TokenBucket(TOKENS_PER_MINUTE)
+        return bucket
+
+
+@contextmanager
+def priority(level: int) -> Iterator[None]:
+    """Les appels faits dans ce bloc (même thread ou tâche asyncio) passent à la priorité `level`."""
+    token = _PRIORITY.set(level)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+def _priority(node: str) -> int:
+    level = _PRIORITY.get()
+    return NODE_PRIORITY.get(node, NORMAL) if level is None else level
+
+
+def estimate_tokens(request: dict) -> int:
+    """Tokens réservés pour une requête : entrée estimée (system, messages, outils) + max_tokens."""
+    return request_tokens(request) + int(request.get("max_tokens", 0))
+
+
+def _used_tokens(result) -> Optional[int]:
+    usage = getattr(result, "usage", None)
+    if usage is None:
+        return None
+    return sum(getattr(usage, name, None) or 0 for name in (
+        "input_tokens", "cache_creation_input_tokens", "output_tokens",
+    ))
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Délai avant la prochaine tentative, ou None si l'erreur n'est pas transitoire."""
+    if isinstance(error, anthropic.APIStatusError):
+        if error.status_code not in RETRYABLE_STATUS:
+            return None
+        retry_after = error.response.headers.get("retry-after") if error.response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), BACKOFF_MAX)
+            except ValueError:
+                pass
+    elif not isinstance(error, anthropic.APIConnectionError):
+        return None
+    # Backoff exponentiel à « full jitter » : les clients en surcharge ne repartent pas ensemble
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def settle(api_key: str, request: dict, message) -> None:
+    """
+    Ajuste la réservation d'un appel streamé sur son usage réel : submit ne connaît
+    que l'ouverture du flux, l'usage n'est disponible qu'avec le message final.
+    Sans message (flux interrompu avant message_start), la réservation est rendue.
+    """
+    bucket = _bucket(api_key)
+    if bucket is not None:
+        bucket.settle(estimate_tokens(request), _used_tokens(message) or 0)
+
+
+def submit(
+    api_key: str, node: str, request: dict, call: Callable[[], T],
+    on_retry: Optional[Callable[[], None]] = None,
+) -> T:
+    """
+    Exécute `call()` (la requête API) en respectant budget, priorité et reprises.
+    Si le résultat porte un usage (Message), la réservation est ajustée dessus ;
+    sinon (flux ouvert) elle est conservée jusqu'à settle().
+    `on_retry` est appelé à chaque nouvelle tentative (télémétrie de l'appel).
+    """
+    bucket = _bucket(api_key)
+    reserved = estimate_tokens(request)
+    priority = _priority(node)
+    attempt = 0
+    while True:
+        if bucket is not None:
+            entry = bucket.enqueue(priority)
+            try:
+                while True:
+                    delay = bucket.try_acquire(entry, reserved)
+                    if not delay:
+                        break
+                    time.sleep(min(delay, 0.25))
+            except BaseException:
+                bucket.leave(entry)
+                raise
+        try:
+            result = call()
+        except BaseException as e:
+            if bucket is not None:
+                bucket.settle(reserved, 0)
+                if isinstance(e, anthropic.RateLimitError):
+                    bucket.drain()
+            if not isinstance(e, Exception):
+                raise
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt >= MAX_RETRIES:
+                raise
+            attempt += 1
+            if on_retry is not None:
+                on_retry()
+            time.sleep(delay)
+            continue
+        used = _used_tokens(result)
+        if bucket is not None and used is not None:
+            bucket.settle(reserved, used)
+        return result
+
+
+async def asubmit(
+    api_key: str, node: str, request: dict, call: Callable[[], Awaitable[T]],
+    on_retry: Optional[Callable[[], None]] = None,
+) -> T:
+    """Version asynchrone de submit : les attentes ne bloquent pas la boucle d'événements."""
+    bucket = _bucket(api_key)
+    reserved = estimate_tokens(request)
+    priority = _priority(node)
+    attempt = 0
+    while True:
+        if bucket is not None:
+            entry = bucket.enqueue(priority)
+            try:
+                while True:
+                    delay = bucket.try_acquire(entry, reserved)
+                    if not delay:
+                        break
+                    await asyncio.sleep(min(delay, 0.25))
+            except BaseException:
+                bucket.leave(entry)
+                raise
+        try:
+            result = await call()
+        except BaseException as e:
+            # CancelledError compris : la réservation est rendue avant de propager
+            if bucket is not None:
+                bucket.settle(reserved, 0)
+                if isinstance(e, anthropic.RateLimitError):
+                    bucket.drain()
+            if not isinstance(e, Exception):
+                raise
+            delay = _retry_delay(e, attempt)
+            if delay is None or attempt >= MAX_RETRIES:
+                raise
+            attempt += 1
+            if on_retry is not None:
+                on_retry()
+            await asyncio.sleep(delay)
+            continue
+        used = _used_tokens(result)
+        if bucket is not None and used is not None:
+            bucket.settle(reserved, used)
+        return result
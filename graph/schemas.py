@@ -0,0 +1,55 @@
+"""
+UtopIA — Schémas de sortie structurée
+Modèles pydantic des réponses JSON des nodes. Chaque schéma est transmis à l'API
+comme outil imposé (tool_choice) : le modèle répond directement avec un objet
+conforme au lieu d'un texte dans lequel il faudrait retrouver le JSON.
+"""
+
+from typing import List, Literal
+
+from pydantic import BaseModel, Field
+
+
+class ModeleConceptuel(BaseModel):
+    """Modèle conceptuel retenu pour l'évaluation du patient."""
+    modele: str = Field(description="Nom du modèle : MCREO, PEO, MOHO ou OTIPM")
+    justification: str = Field(description="Justification clinique du choix")
+    axes_evaluation: List[str] = Field(description="4 axes d'évaluation prioritaires")
+
+
+class PropositionAT(BaseModel):
+    categorie: str = Field(description="Code catégorie VPH")
+    modele: str = Field(description="Nom commercial")
+    justification_clinique: str = Field(description="3-4 phrases")
+    caracteristiques_cles: List[str] = Field(description="4 points")
+    code_lpp: str = Field(default="", description="Code LPP, vide si inconnu")
+    remboursement: str = Field(description="achat, LCD ou LLD")
+    avantages: List[str] = Field(description="2-3 avantages")
+    points_vigilance: List[str] = Field(description="1-2 points de vigilance")
+
+
+class PropositionsAT(BaseModel):
+    """Aides techniques (VPH) proposées pour le patient."""
+    propositions: List[PropositionAT] = Field(min_length=1, description="3 propositions")
+
+
+class ProchaineQuestion(BaseModel):
+    """Suite de l'entretien clinique : prochaine question, ou fin de l'entretien avec sa synthèse."""
+    termine: bool = Field(description="true si les informations suffisent pour préconiser")
+    question: str = Field(default="", description="Prochaine question avec sous-points (si termine = false)")
+    synthese: str = Field(
+        default="",
+        description=(
+            "Si termine = true : synthèse clinique structurée en 4-5 phrases (propulsion et endurance, "
+            "contrôle postural, transferts, contraintes environnementales, éléments déterminants "
+            "pour le choix du VPH), intégrée telle quelle au dossier patient"
+        ),
+    )
+
+
+class ResumeCPAM(BaseModel):
+    """Informations clés du dossier pour les fiches CPAM."""
+    categorie_vph: str
+    mode_prise_en_charge: Literal["achat", "LCD", "LLD"]
+    justification_courte: str
+    points_cles: List[str] = Field(description="3 points clés")
@@ -0,0 +1,186 @@
+"""
+UtopIA — Télémétrie des appels LLM
+Chaque appel d'un node (cf. graph.llm) laisse une ligne dans UTOPIA_CACHE_DIR/telemetry.sqlite :
+node, modèle, hit du cache des nodes, temps jusqu'au premier token (appels streamés),
+latence totale, tokens d'entrée / sortie / écrits et lus dans le cache, reprises,
+sorties structurées invalides et erreur éventuelle.
+La vue SQL `node_stats` et summary() agrègent ces lignes par node et par modèle :
+
+    python -m graph.telemetry
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from graph.memo import CACHE_DIR
+
+TELEMETRY_ENABLED = os.environ.get("UTOPIA_TELEMETRY", "1") != "0"
+
+COLUMNS = (
+    "ts", "node", "model", "memo_hit", "streamed", "ttft", "latency",
+    "input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens",
+    "retries", "parse_failures", "error",
+)
+
+_LOCK = threading.Lock()
+_CONN: Optional[sqlite3.Connection] = None
+
+
+def _connection() -> sqlite3.Connection:
+    global _CONN
+    if _CONN is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        _CONN = sqlite3.connect(str(CACHE_DIR / "telemetry.sqlite"), check_same_thread=False)
+        _CONN.executescript("""
+            CREATE TABLE IF NOT EXISTS calls (
+                ts REAL NOT NULL, node TEXT NOT NULL, model TEXT,
+                memo_hit INTEGER NOT NULL, streamed INTEGER NOT NULL,
+                ttft REAL, latency REAL NOT NULL,
+                input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL,
+                cache_creation_input_tokens INTEGER NOT NULL, cache_read_input_tokens INTEGER NOT NULL,
+                retries INTEGER NOT NULL, parse_failures INTEGER NOT NULL, error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS calls_node ON calls (node, model);
+            CREATE VIEW IF NOT EXISTS node_stats AS
+            SELECT node, model,
+                   COUNT(*) AS calls,
+                   SUM(memo_hit) AS memo_hits,
+                   AVG(CASE WHEN memo_hit = 0 AND error IS NULL THEN latency END) AS avg_latency,
+                   MAX(latency) AS max_latency,
+                   AVG(ttft) AS avg_ttft,
+                   SUM(input_tokens) AS input_tokens,
+                   SUM(output_tokens) AS output_tokens,
+                   SUM(cache_creation_input_tokens) AS cache_creation_input_tokens,
+                   SUM(cache_read_input_tokens) AS cache_read_input_tokens,
+                   SUM(retries) AS retries,
+                   SUM(parse_failures) AS parse_failures,
+                   SUM(error IS NOT NULL) AS errors
+            FROM calls GROUP BY node, model;
+        """)
+        _CONN.commit()
+    return _CONN
+
+
+class Call:
+    """Mesures d'un appel de node, enregistrées par save()."""
+
+    def __init__(self, node: str, model: Optional[str], streamed: bool = False):
+        self.node = node
+        self.model = model
+        self.streamed = streamed
+        self.started = time.monotonic()
+        self.memo_hit = False
+        self.ttft: Optional[float] = None
+        self.latency: Optional[float] = None
+        self.usage: Dict[str, int] = {}
+        self.retries = 0
+        self.parse_failures = 0
+        self.error: Optional[str] = None
+
+    def retry(self) -> None:
+        self.retries += 1
+
+    def first_token(self) -> None:
+        if self.ttft is None:
+            self.ttft = time.monotonic() - self.started
+
+    def finish(self, usage: Optional[Dict[str, int]] = None) -> float:
+        self.latency = time.monotonic() - self.started
+        self.usage = usage or {}
+        return self.latency
+
+    def fail(self, error: BaseException, usage: Optional[Dict[str, int]] = None) -> None:
+        self.finish(usage)
+        message = str(error)[:300]
+        self.error = type(error).__name__ + (": " + message if message else "")
+        self.save()
+
+    def save(self) -> None:
+        if not TELEMETRY_ENABLED:
+            return
+        if self.latency is None:
+            self.finish()
+        row = (
+            time.time(), self.node, self.model, int(self.memo_hit), int(self.streamed),
+            self.ttft, self.latency,
+            self.usage.get("input_tokens", 0), self.usage.get("output_tokens", 0),
+            self.usage.get("cache_creation_input_tokens", 0), self.usage.get("cache_read_input_tokens", 0),
+            self.retries, self.parse_failures, self.error,
+        )
+        # La télémétrie ne doit jamais faire échouer un appel
+        try:
+            with _LOCK:
+                conn = _connection()
+                conn.execute(
+                    "INSERT INTO calls (" + ", ".join(COLUMNS) + ") VALUES (" + ", ".join("?" * len(COLUMNS)) + ")",
+                    row,
+                )
+                conn.commit()
+        except sqlite3.Error:
+            pass
+
+
+def _percentile(sorted_values: list, q: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, round(q * len(sorted_values)) - 1))]
+
+
+def summary(since: Optional[float] = None) -> Dict[str, Dict[str, dict]]:
+    """
+    Agrégats par node puis par modèle (appels depuis le timestamp `since` si fourni) :
+    ceux de la vue node_stats, plus les latences et TTFT p50 / p95 des appels réels aboutis.
+    """
+    where, params = ("WHERE ts >= ?", (since,)) if since is not None else ("", ())
+    with _LOCK:
+        conn = _connection()
+        rows = conn.execute(
+            "SELECT node, model, memo_hit, latency, ttft, input_tokens, output_tokens, "
+            "cache_creation_input_tokens, cache_read_input_tokens, retries, parse_failures, error "
+            "FROM calls " + where, params,
+        ).fetchall()
+
+    groups: Dict[tuple, list] = {}
+    for row in rows:
+        groups.setdefault((row[0], row[1]), []).append(row)
+
+    stats: Dict[str, Dict[str, dict]] = {}
+    for (node, model), group in groups.items():
+        real = [r for r in group if not r[2] and not r[11]]  # appels réels aboutis
+        latencies = sorted(r[3] for r in real)
+        ttfts = sorted(r[4] for r in real if r[4] is not None)
+        stats.setdefault(node, {})[model] = {
+            "calls": len(group),
+            "memo_hits": sum(1 for r in group if r[2]),
+            "latency_p50": _percentile(latencies, 0.50),
+            "latency_p95": _percentile(latencies, 0.95),
+            "ttft_p50": _percentile(ttfts, 0.50),
+            "ttft_p95": _percentile(ttfts, 0.95),
+            "input_tokens": sum(r[5] for r in group),
+            "output_tokens": sum(r[6] for r in group),
+            "cache_creation_input_tokens": sum(r[7] for r in group),
+            "cache_read_input_tokens": sum(r[8] for r in group),
+            "retries": sum(r[9] for r in group),
+            "parse_failures": sum(r[10] for r in group),
+            "errors": sum(1 for r in group if r[11]),
+        }
+    return stats
+
+
+if __name__ == "__main__":
+    def _fmt(value) -> str:
+        return "-" if value is None else f"{value:.2f}s"
+
+    for node, models in sorted(summary().items()):
+        for model, s in models.items():
+            print(
+                f"{node:<26} {model or '?':<28} appels {s['calls']:>5} (cache {s['memo_hits']:>4})"
+                f"  p50 {_fmt(s['latency_p50']):>7}  p95 {_fmt(s['latency_p95']):>7}"
+                f"  TTFT p50 {_fmt(s['ttft_p50']):>7}"
+                f"  tokens {s['input_tokens']:>8} → {s['output_tokens']:>7}"
+                f" (cache lu {s['cache_read_input_tokens']})"
+                f"  reprises {s['retries']}  JSON invalides {s['parse_failures']}  erreurs {s['errors']}"
+            )
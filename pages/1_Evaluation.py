@@ -3,8 +3,12 @@ UtopIA — Page 1 : Évaluation des besoins (OTIPM Phase 1-2)
 Recueil structuré Personne / Environnement / Occupation
 """
 
+import uuid
+
 import streamlit as st
 from graph.state import PatientState
+from graph.nodes.chat_clinique import prefetch_first_question
+from rag.store import get_vectorstore
 
 st.set_page_config(page_title="📋 Évaluation — UtopIA", layout="wide")
 
@@ -209,5 +213,9 @@ with col2:
             st.session_state.chat_history = []
             st.session_state.chat_termine = False
             st.session_state.chat_synthese = ""
+            # La première question de l'entretien est préparée pendant que l'ergothérapeute change de page
+            if st.session_state.get("api_key"):
+                session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+                prefetch_first_question(patient, st.session_state.api_key, session_id, get_vectorstore())
             st.success("✅ Profil enregistré. Rendez-vous sur la page **Entretien** dans le menu.")
             st.balloons()
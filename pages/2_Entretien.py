@@ -2,12 +2,14 @@
 UtopIA — Page 1b : Entretien clinique complémentaire
 Questions ciblées générées par UtopIA avant la préconisation
 """
+import uuid
+
 import streamlit as st
 from graph.state import PatientState
+from rag.store import get_vectorstore
 from graph.nodes.chat_clinique import (
-    generate_first_question,
+    get_first_question,
     generate_next_question,
-    build_chat_synthesis,
 )
 
 st.set_page_config(page_title="Entretien — UtopIA", layout="wide")
@@ -85,7 +87,7 @@ if "patient" not in st.session_state or not st.session_state.patient.diagnostic:
 
 patient: PatientState = st.session_state.patient
 api_key = st.session_state.get("api_key", "")
-vectorstore = st.session_state.get("vectorstore", None)
+vectorstore = get_vectorstore()
 
 if not api_key:
     st.error("🔑 Clé API manquante. Configurez-la sur la page d'accueil.")
@@ -122,7 +124,9 @@ if not st.session_state.chat_history:
         if st.button("🚀 Démarrer l'entretien", use_container_width=True):
             with st.spinner("UtopIA prépare sa première question..."):
                 try:
-                    question = generate_first_question(patient, api_key, vectorstore)
+                    # Déjà générée en arrière-plan à l'enregistrement du profil, le plus souvent
+                    session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+                    question = get_first_question(patient, api_key, session_id, vectorstore)
                     st.session_state.chat_history.append({
                         "role": "assistant",
                         "content": question
@@ -208,11 +212,8 @@ elif st.session_state.chat_history:
                         )
 
                         if result.get("termine", False):
-                            # Générer la synthèse
-                            synthese = build_chat_synthesis(
-                                patient, api_key,
-                                st.session_state.chat_history
-                            )
+                            # La synthèse arrive avec la décision de fin d'entretien
+                            synthese = result.get("synthese", "")
                             # Sauvegarder dans le patient
                             patient.synthese_demande = (
                                 (patient.synthese_demande + "\n\n" if patient.synthese_demande else "") +
@@ -220,7 +221,7 @@ elif st.session_state.chat_history:
                             )
                             st.session_state.patient = patient
                             st.session_state.chat_termine = True
-                            st.session_state.chat_synthese = result.get("synthese", synthese)
+                            st.session_state.chat_synthese = synthese
                         else:
                             question = result.get("question", "")
                             if question:
@@ -248,17 +249,14 @@ elif st.session_state.chat_history:
                             vectorstore
                         )
                         if result.get("termine", False):
-                            synthese = build_chat_synthesis(
-                                patient, api_key,
-                                st.session_state.chat_history
-                            )
+                            synthese = result.get("synthese", "")
                             patient.synthese_demande = (
                                 (patient.synthese_demande + "\n\n" if patient.synthese_demande else "") +
                                 "Synthèse entretien clinique :\n" + synthese
                             )
                             st.session_state.patient = patient
                             st.session_state.chat_termine = True
-                            st.session_state.chat_synthese = result.get("synthese", synthese)
+                            st.session_state.chat_synthese = synthese
                         else:
                             question = result.get("question", "")
                             if question:
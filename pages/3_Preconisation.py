@@ -2,11 +2,17 @@
 UtopIA — Page 2 : Préconisation AT
 Sélection modèle conceptuel → Diagnostic ergo → Recherche AT
 """
+import copy
+import uuid
+
 import streamlit as st
+from graph import jobs
 from graph.state import PatientState
+from rag.store import get_vectorstore
 from graph.nodes.model_selector import select_model_conceptuel
-from graph.nodes.diagnostic_writer import write_diagnostic
+from graph.nodes.diagnostic_writer import stream_diagnostic
 from graph.nodes.at_researcher import search_at, determine_vph_category
+from graph.preconisation import run_preconisation_detached
 
 st.set_page_config(page_title="🔬 Préconisation — UtopIA", layout="wide")
 
@@ -63,12 +69,58 @@ if not api_key:
     st.error("🔑 Clé API Anthropic manquante. Configurez-la sur la page d'accueil.")
     st.stop()
 
-vectorstore = st.session_state.get("vectorstore", None)
+vectorstore = get_vectorstore()
+
+# Les générations longues tournent en tâches de fond (cf. graph.jobs) : un rerun
+# de la page ne les interrompt pas, elles sont retrouvées par leur clé de session
+session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+job_keys = {name: jobs.session_key(session_id, name) for name in ("preconisation", "diagnostic", "aides_techniques")}
 
 # ── En-tête ─────────────────────────────────────────────────────────────────
 st.markdown(f"# 🔬 Préconisation — {patient.prenom} {patient.nom}")
 st.caption(f"Diagnostic : {patient.diagnostic} · {patient.age} ans · {patient.lieu_vie}")
 
+# ── Mode automatique : toutes les étapes enchaînées ─────────────────────────
+col1, col2 = st.columns([3, 1])
+with col1:
+    st.caption("Enchaîne modèle conceptuel → diagnostic → catégorie VPH → recherche AT. "
+               "Les étapes dont les données d'entrée n'ont pas changé sont conservées.")
+with col2:
+    generer_tout = st.button("⚡ Tout générer", use_container_width=True)
+    regenerer_tout = bool(patient.diagnostic_ergo) and st.button("🔄 Tout régénérer", use_container_width=True)
+    if generer_tout or regenerer_tout:
+        # Copie du patient : la tâche n'est pas affectée par les saisies faites pendant son exécution.
+        # « Tout régénérer » relance chaque étape en contournant le cache
+        jobs.submit(
+            job_keys["preconisation"], run_preconisation_detached,
+            copy.deepcopy(patient), api_key, vectorstore, on_step=jobs.PROGRESS,
+            cache=st.session_state.setdefault("preconisation_cache", {}),
+            refresh=regenerer_tout,
+        )
+
+job = jobs.get(job_keys["preconisation"])
+if job is not None:
+    with st.status("Préconisation complète en cours...", expanded=True) as status:
+        etapes = st.empty()
+
+        def preconisation_prete(result: dict) -> None:
+            for name, value in result["outputs"].items():
+                setattr(patient, name, value)
+            if result["axes_evaluation"] is not None:
+                st.session_state["axes_evaluation"] = result["axes_evaluation"]
+            st.session_state.patient = patient
+            status.update(label="Préconisation complète générée", state="complete")
+            st.rerun()
+
+        def preconisation_echouee(message: str) -> None:
+            status.update(label="Erreur pendant la préconisation", state="error")
+            st.error(message)
+
+        jobs.follow(
+            job, on_progress=lambda j: etapes.markdown("  \n".join(j.log)),
+            on_done=preconisation_prete, on_error=preconisation_echouee,
+        )
+
 # ═══════════════════════════════════════════════════════════════════════════
 # ÉTAPE 1 : MODÈLE CONCEPTUEL
 # ═══════════════════════════════════════════════════════════════════════════
@@ -89,10 +141,12 @@ with col1:
         st.info("Cliquez sur le bouton pour analyser le profil et sélectionner le modèle conceptuel adapté.")
 
 with col2:
-    if st.button("🤖 Analyser le profil", use_container_width=True):
+    analyser = st.button("🤖 Analyser le profil", use_container_width=True)
+    reanalyser = bool(patient.modele_conceptuel_choisi) and st.button("🔄 Nouvelle analyse", use_container_width=True)
+    if analyser or reanalyser:
         with st.spinner("Analyse du profil patient..."):
             try:
-                result = select_model_conceptuel(patient, api_key, vectorstore)
+                result = select_model_conceptuel(patient, api_key, vectorstore, refresh=reanalyser)
                 patient.modele_conceptuel_choisi = result.get("modele", "MCREO")
                 patient.justification_modele = result.get("justification", "")
                 axes = result.get("axes_evaluation", [])
@@ -130,12 +184,30 @@ st.markdown('<div class="section-header">📄 Étape 2 — Diagnostic ergothéra
 
 col1, col2 = st.columns([3, 1])
 with col2:
-    if st.button("✍️ Rédiger le diagnostic", use_container_width=True,
-                 disabled=not patient.modele_conceptuel_choisi):
-        with st.spinner("Rédaction du diagnostic ergothérapique..."):
-            patient.diagnostic_ergo = write_diagnostic(patient, api_key, vectorstore)
-            st.session_state.patient = patient
-            st.rerun()
+    rediger = st.button("✍️ Rédiger le diagnostic", use_container_width=True,
+                        disabled=not patient.modele_conceptuel_choisi)
+    # Profil inchangé : « Rédiger » ressert la version mémoïsée, « Nouvelle version » force un appel
+    nouvelle_version = bool(patient.diagnostic_ergo) and st.button("🔄 Nouvelle version", use_container_width=True)
+
+    if rediger or nouvelle_version:
+        jobs.submit_stream(
+            job_keys["diagnostic"], stream_diagnostic,
+            copy.deepcopy(patient), api_key, vectorstore, refresh=nouvelle_version,
+        )
+
+job = jobs.get(job_keys["diagnostic"])
+if job is not None:
+    placeholder = col1.empty()
+
+    def diagnostic_pret(texte: str) -> None:
+        patient.diagnostic_ergo = texte
+        st.session_state.patient = patient
+        st.rerun()
+
+    jobs.follow(
+        job, on_progress=lambda j: placeholder.markdown(j.partial_text + " ▌"),
+        on_done=diagnostic_pret, on_error=col1.error,
+    )
 
 with col1:
     if patient.diagnostic_ergo:
@@ -183,10 +255,13 @@ with col3:
     st.markdown("<br>", unsafe_allow_html=True)
     auto_cat = st.button("🎯 Détecter la catégorie", use_container_width=True,
                          disabled=not patient.diagnostic_ergo)
+    redetecter = bool(patient.categorie_vph_recommandee) and st.button(
+        "🔄 Nouvelle détection", use_container_width=True, disabled=not patient.diagnostic_ergo
+    )
 
-if auto_cat:
+if auto_cat or redetecter:
     with st.spinner("Détection de la catégorie VPH..."):
-        cat = determine_vph_category(patient, api_key, vectorstore)
+        cat = determine_vph_category(patient, api_key, vectorstore, refresh=redetecter)
         patient.categorie_vph_recommandee = cat
         st.session_state.patient = patient
         st.rerun()
@@ -196,14 +271,32 @@ st.session_state.patient = patient
 # Recherche AT
 col1, col2 = st.columns([3, 1])
 with col2:
-    if st.button("🔍 Rechercher les AT", use_container_width=True,
-                 disabled=not patient.diagnostic_ergo):
-        with st.spinner("Recherche des aides techniques adaptées..."):
-            propositions = search_at(patient, api_key, vectorstore)
+    rechercher = st.button("🔍 Rechercher les AT", use_container_width=True,
+                           disabled=not patient.diagnostic_ergo)
+    nouvelle_recherche = bool(patient.propositions_at) and st.button(
+        "🔄 Nouvelle recherche", use_container_width=True, disabled=not patient.diagnostic_ergo
+    )
+    if rechercher or nouvelle_recherche:
+        jobs.submit(
+            job_keys["aides_techniques"], search_at,
+            copy.deepcopy(patient), api_key, vectorstore, refresh=nouvelle_recherche,
+        )
+
+job = jobs.get(job_keys["aides_techniques"])
+if job is not None:
+    with st.spinner("Recherche des aides techniques adaptées..."):
+        attente = st.empty()
+
+        def propositions_pretes(propositions: list) -> None:
             patient.propositions_at = propositions
             st.session_state.patient = patient
             st.rerun()
 
+        jobs.follow(
+            job, on_progress=lambda j: attente.caption(f"Recherche en cours depuis {j.elapsed:.0f} s"),
+            on_done=propositions_pretes, on_error=st.error,
+        )
+
 with col1:
     if not patient.diagnostic_ergo:
         st.markdown('<div class="warning-box">⚠️ Rédigez d\'abord le diagnostic ergothérapique.</div>',
@@ -2,9 +2,14 @@
 UtopIA — Page 4 : Argumentaire CPAM + Export
 Génération de l'argumentaire normé et du dossier complet
 """
+import copy
+import uuid
+
 import streamlit as st
+from graph import jobs
 from graph.state import PatientState
-from graph.nodes.argumentaire import write_argumentaire
+from rag.store import get_vectorstore
+from graph.nodes.argumentaire import stream_argumentaire
 from datetime import datetime
 
 st.set_page_config(page_title="📑 Argumentaire — UtopIA", layout="wide")
@@ -51,7 +56,7 @@ if "patient" not in st.session_state or not st.session_state.patient.at_retenue:
 
 patient: PatientState = st.session_state.patient
 api_key = st.session_state.get("api_key", "")
-vectorstore = st.session_state.get("vectorstore", None)
+vectorstore = get_vectorstore()
 
 # ── En-tête ─────────────────────────────────────────────────────────────────
 st.markdown(f"# 📑 Argumentaire CPAM — {patient.prenom} {patient.nom}")
@@ -93,27 +98,58 @@ if not all_ok:
 st.markdown('<div class="section-header">📝 Argumentaire de prise en charge</div>',
             unsafe_allow_html=True)
 
+session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+# Une tâche par mode : « Version finale » n'est pas absorbée par un brouillon en cours
+job_keys = {mode: jobs.session_key(session_id, "argumentaire/" + mode) for mode in ("draft", "final")}
+
 col1, col2 = st.columns([3, 1])
 with col2:
-    if st.button("🤖 Générer l'argumentaire", use_container_width=True):
-        with st.spinner("Rédaction de l'argumentaire CPAM..."):
-            patient.argumentaire_cpam = write_argumentaire(patient, api_key, vectorstore)
-            st.session_state.patient = patient
-            st.rerun()
+    generer = st.button("🤖 Générer l'argumentaire", use_container_width=True)
+    regenerer = bool(patient.argumentaire_cpam) and st.button("🔄 Régénérer", use_container_width=True)
+    finaliser = bool(patient.argumentaire_cpam) and st.button(
+        "✨ Version finale", use_container_width=True,
+        help="Relecture du brouillon, avec vos modifications, par le modèle haute qualité (plus lente)",
+    )
+
+    if generer or regenerer or finaliser:
+        # Tâche détachée du script : elle se poursuit si la page est relancée ou quittée.
+        # « Régénérer » contourne le cache ; « Version finale » passe au modèle de qualité.
+        # La dernière demande l'emporte : la tâche de l'autre mode est interrompue.
+        mode = "final" if finaliser else "draft"
+        if finaliser:
+            # Brouillon tel que modifié dans la zone de texte (valeur transmise avec le clic)
+            patient.argumentaire_cpam = st.session_state.get("argumentaire_texte", patient.argumentaire_cpam)
+        for other, key in job_keys.items():
+            if other != mode:
+                jobs.cancel(key)
+        jobs.submit_stream(
+            job_keys[mode], stream_argumentaire,
+            copy.deepcopy(patient), api_key, vectorstore, refresh=regenerer, mode=mode,
+        )
 
-    if patient.argumentaire_cpam:
-        if st.button("🔄 Régénérer", use_container_width=True):
-            with st.spinner("Nouvelle version..."):
-                patient.argumentaire_cpam = write_argumentaire(patient, api_key, vectorstore)
-                st.session_state.patient = patient
-                st.rerun()
+job = next(filter(None, (jobs.get(key) for key in job_keys.values())), None)
+if job is not None:
+    # Affichage au fil de l'eau dans la colonne de gauche, jusqu'à la fin de la tâche
+    placeholder = col1.empty()
+
+    def argumentaire_pret(texte: str) -> None:
+        patient.argumentaire_cpam = texte
+        st.session_state.patient = patient
+        st.session_state.pop("argumentaire_texte", None)  # la zone de texte repart du nouveau texte
+        st.rerun()
+
+    jobs.follow(
+        job, on_progress=lambda j: placeholder.markdown(j.partial_text + " ▌"),
+        on_done=argumentaire_pret, on_error=col1.error,
+    )
 
 with col1:
     if patient.argumentaire_cpam:
         patient.argumentaire_cpam = st.text_area(
             "Argumentaire (modifiable avant export)",
             value=patient.argumentaire_cpam,
-            height=350
+            height=350,
+            key="argumentaire_texte",
         )
         st.session_state.patient = patient
     else:
@@ -285,4 +321,8 @@ Document généré par UtopIA — Agent d'aide à la préconisation VPH
                 del st.session_state["obs_par_vph"]
             if "axes_evaluation" in st.session_state:
                 del st.session_state["axes_evaluation"]
+            if "preconisation_cache" in st.session_state:
+                del st.session_state["preconisation_cache"]
+            for key in job_keys.values():
+                jobs.cancel(key)
             st.success("✅ Nouveau patient initialisé. Retournez à la page Évaluation.")
@@ -0,0 +1,193 @@
+"""
+UtopIA — Pipeline d'embeddings
+Vectorisation par lots triés par longueur (moins de padding), avec mesure du débit
+et du pic mémoire pour régler batch size et threads sur les hôtes CPU.
+Les vecteurs sont mis en cache sur disque, indexés par modèle + hash du texte normalisé.
+"""
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+EMBED_BATCH_SIZE = int(os.environ.get("UTOPIA_EMBED_BATCH_SIZE", "64"))
+EMBED_THREADS = int(os.environ.get("UTOPIA_EMBED_THREADS", "0"))  # 0 = défaut torch
+
+
+@dataclass
+class EmbeddingStats:
+    chunks: int = 0
+    batches: int = 0
+    cache_hits: int = 0
+    seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+
+    @property
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.seconds if self.seconds else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f"{self.chunks} chunks en {self.batches} lots ({self.cache_hits} depuis le cache), "
+            f"{self.seconds:.1f}s ({self.chunks_per_second:.1f} chunks/s), "
+            f"pic mémoire {self.peak_rss_mb:.0f} Mo"
+        )
+
+
+def peak_rss_mb() -> float:
+    """Pic de mémoire résidente du processus, en Mo (0 si non mesurable)."""
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss est en octets sur macOS, en kilo-octets sur Linux
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def normalize_text(text: str) -> str:
+    """Normalisation Unicode + espaces, pour que les chunks identiques partagent leur clé."""
+    return unicodedata.normalize("NFC", " ".join(text.split()))
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Enveloppe un modèle d'embeddings avec un cache SQLite persistant.
+    Clé : sha256(nom du modèle + texte normalisé) — les chunks déjà vectorisés
+    (pieds de page, champs de formulaire répétés, reconstructions après
+    modification de CHUNK_CONFIG) ne repassent pas par le modèle.
+    Les requêtes (embed_query) ne sont pas mises en cache ici.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, cache_path: Path):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(cache_path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _key(self, text: str) -> str:
+        raw = (self.model_name + "\n" + normalize_text(text)).encode("utf-8")
+        return hashlib.sha256(raw).hexdigest()
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            for offset in range(0, len(unique), 500):
+                part = unique[offset:offset + 500]
+                rows = self._conn.execute(
+                    "SELECT key, vector FROM embeddings WHERE key IN (%s)" % ",".join("?" * len(part)),
+                    part,
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+        return found
+
+    def _store(self, items: Dict[str, List[float]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in items.items()],
+            )
+            self._conn.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(t) for t in texts]
+        vectors = self._lookup(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in vectors and key not in missing:
+                missing[key] = text
+        if missing:
+            computed = self.underlying.embed_documents(list(missing.values()))
+            new_items = dict(zip(missing.keys(), computed))
+            self._store(new_items)
+            vectors.update(new_items)
+
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        return [vectors[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+
+def load_embeddings(
+    model_name: str,
+    batch_size: Optional[int] = None,
+    cache_path: Optional[Path] = None,
+) -> Embeddings:
+    # Embeddings multilingues locaux — excellent pour le français, aucune clé requise
+    if EMBED_THREADS:
+        try:
+            import torch
+            torch.set_num_threads(EMBED_THREADS)
+        except ImportError:
+            pass
+    embeddings = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": "cpu"},
+        encode_kwargs={
+            "normalize_embeddings": True,
+            "batch_size": batch_size or EMBED_BATCH_SIZE,
+        },
+    )
+    if cache_path is None:
+        return embeddings
+    return CachedEmbeddings(embeddings, model_name, cache_path)
+
+
+def add_documents_batched(
+    vectorstore,
+    docs: List[Document],
+    ids: List[str],
+    batch_size: Optional[int] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> EmbeddingStats:
+    """
+    Ajoute les chunks au vectorstore par lots de taille fixe, triés par longueur
+    pour que chaque lot contienne des textes de taille voisine.
+    `progress(fait, total)` est appelé après chaque lot.
+    """
+    batch_size = batch_size or EMBED_BATCH_SIZE
+    order = sorted(range(len(docs)), key=lambda i: len(docs[i].page_content))
+    stats = EmbeddingStats()
+    embeddings = vectorstore.embeddings
+    hits_before = getattr(embeddings, "hits", 0)
+    start = time.perf_counter()
+
+    for offset in range(0, len(order), batch_size):
+        batch = order[offset:offset + batch_size]
+        vectorstore.add_documents([docs[i] for i in batch], ids=[ids[i] for i in batch])
+        stats.chunks += len(batch)
+        stats.batches += 1
+        if progress:
+            progress(stats.chunks, len(order))
+
+    stats.seconds = time.perf_counter() - start
+    stats.cache_hits = getattr(embeddings, "hits", 0) - hits_before
+    stats.peak_rss_mb = peak_rss_mb()
+    return stats
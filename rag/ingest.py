@@ -1,20 +1,48 @@
 """
 UtopIA — Ingestion RAGG
 Embeddings locaux via sentence-transformers (pas de clé API supplémentaire).
+L'index Chroma est persisté sur disque ; un manifeste (hash par fichier et par page)
+permet de ne ré-embedder que les pages nouvelles ou modifiées.
 """
 
+import hashlib
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 
 import fitz
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
-from langchain_huggingface import HuggingFaceEmbeddings
+
+from rag.embeddings import add_documents_batched, load_embeddings
+from rag.retriever import precompute_fixed_contexts
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 DOCS_DIR = BASE_DIR / "docs"
 
+# Répertoire de l'index persistant (surchargeable par variable d'environnement)
+INDEX_DIR = Path(os.environ.get("UTOPIA_INDEX_DIR", str(BASE_DIR / ".index")))
+MANIFEST_FILE = "manifest.json"
+FIXED_CONTEXTS_FILE = "fixed_contexts.json"
+EMBEDDING_CACHE_FILE = "embedding_cache.sqlite"
+COLLECTION_NAME = "utopia"
+
+EMBEDDING_MODEL = "paraphrase-multilingual-MiniLM-L12-v2"
+
+# Extraction parallèle : un worker par cœur par défaut, tâches de PAGES_PER_TASK pages
+INGEST_WORKERS = int(os.environ.get("UTOPIA_INGEST_WORKERS", "0")) or (os.cpu_count() or 1)
+PAGES_PER_TASK = 32
+# Workers démarrés par un serveur dédié (ou spawn), jamais par fork : le processus Streamlit
+# est multi-threadé et peut avoir chargé torch, un fork risquerait un interblocage.
+MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
 CHUNK_CONFIG = {
     "reglementation":      {"chunk_size": 800,  "chunk_overlap": 150},
     "evaluation-clinique": {"chunk_size": 600,  "chunk_overlap": 120},
@@ -25,48 +53,83 @@ CHUNK_CONFIG = {
 DEFAULT_CHUNK = {"chunk_size": 600, "chunk_overlap": 120}
 
 
-def extract_pdf(path: Path) -> List[Document]:
-    docs = []
+def _extract_page_range(path_str: str, start: int, stop: int) -> List[Tuple[int, str]]:
+    """Extrait le texte des pages [start, stop) — exécuté dans un processus worker."""
+    pages = []
     try:
-        pdf = fitz.open(str(path))
-        for page_num, page in enumerate(pdf):
-            text = page.get_text().strip()
+        pdf = fitz.open(path_str)
+        for page_num in range(start, min(stop, pdf.page_count)):
+            text = pdf[page_num].get_text().strip()
             if len(text) < 50:
                 continue
-            docs.append(Document(
-                page_content=text,
-                metadata={
-                    "source": path.name,
-                    "category": path.parent.name,
-                    "page": page_num + 1,
-                }
-            ))
+            pages.append((page_num + 1, text))
         pdf.close()
+    except Exception as e:
+        print(f"Erreur extraction {Path(path_str).name} (pages {start + 1}-{stop}): {e}")
+    return pages
+
+
+def _page_count(path: Path) -> int:
+    try:
+        with fitz.open(str(path)) as pdf:
+            return pdf.page_count
     except Exception as e:
         print(f"Erreur extraction {path.name}: {e}")
-    return docs
+        return 0
 
 
-def build_vectorstore(api_key: str) -> Chroma:
+def extract_pdfs(paths: List[Path], max_workers: Optional[int] = None) -> List[List[Document]]:
     """
-    Construit le vectorstore en mémoire.
-    api_key est gardé en paramètre pour la compatibilité mais non utilisé ici.
+    Extrait plusieurs PDFs en parallèle, découpés par fichier et par plage de pages.
+    Le résultat suit l'ordre de `paths` puis l'ordre des pages, quel que soit
+    l'ordre de fin des workers.
     """
-    pdf_files = sorted(DOCS_DIR.rglob("*.pdf"))
-    if not pdf_files:
-        raise FileNotFoundError(f"Aucun PDF trouvé dans {DOCS_DIR}")
+    tasks = []
+    for file_idx, path in enumerate(paths):
+        for start in range(0, _page_count(path), PAGES_PER_TASK):
+            tasks.append((file_idx, str(path), start, start + PAGES_PER_TASK))
 
-    # Extraction
-    all_raw = []
-    for pdf_path in pdf_files:
-        all_raw.extend(extract_pdf(pdf_path))
+    workers = max_workers or INGEST_WORKERS
+    results = {}
+    if workers > 1 and len(tasks) > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(tasks)), mp_context=MP_CONTEXT) as pool:
+                futures = {
+                    pool.submit(_extract_page_range, path_str, start, stop): (file_idx, start)
+                    for file_idx, path_str, start, stop in tasks
+                }
+                for future, key in futures.items():
+                    results[key] = future.result()
+        except (OSError, BrokenProcessPool) as e:
+            print(f"Extraction parallèle indisponible ({e}), repli séquentiel")
+            results = {}
+    if not results:
+        for file_idx, path_str, start, stop in tasks:
+            results[(file_idx, start)] = _extract_page_range(path_str, start, stop)
 
-    if not all_raw:
-        raise ValueError("Aucun texte extrait des PDFs.")
+    per_file = [[] for _ in paths]
+    for file_idx, start in sorted(results):
+        path = paths[file_idx]
+        for page_num, text in results[(file_idx, start)]:
+            per_file[file_idx].append(Document(
+                page_content=text,
+                metadata={
+                    "source": path.name,
+                    "category": path.parent.name,
+                    "page": page_num,
+                }
+            ))
+    return per_file
+
+
+def extract_pdf(path: Path, max_workers: Optional[int] = None) -> List[Document]:
+    return extract_pdfs([path], max_workers=max_workers)[0]
 
-    # Chunking
+
+def split_documents(raw_docs: List[Document]) -> List[Document]:
+    """Découpe les pages extraites selon la configuration de leur catégorie."""
     all_chunks = []
-    for doc in all_raw:
+    for doc in raw_docs:
         category = doc.metadata.get("category", "default")
         config = CHUNK_CONFIG.get(category, DEFAULT_CHUNK)
         splitter = RecursiveCharacterTextSplitter(
@@ -78,17 +141,199 @@ def build_vectorstore(api_key: str) -> Chroma:
         for c in chunks:
             c.metadata.update(doc.metadata)
         all_chunks.extend(chunks)
+    return all_chunks
 
-    # Embeddings multilingues locaux — excellent pour le français, aucune clé requise
-    embeddings = HuggingFaceEmbeddings(
-        model_name="paraphrase-multilingual-MiniLM-L12-v2",
-        model_kwargs={"device": "cpu"},
-        encode_kwargs={"normalize_embeddings": True},
-    )
 
-    vectorstore = Chroma.from_documents(
-        documents=all_chunks,
-        embedding=embeddings,
-        collection_name="utopia",
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _text_sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def config_fingerprint() -> str:
+    """
+    Empreinte de la configuration de découpage et du modèle d'embeddings.
+    Toute modification impose une reconstruction complète de l'index.
+    """
+    payload = {
+        "embedding_model": EMBEDDING_MODEL,
+        "chunk_config": CHUNK_CONFIG,
+        "default_chunk": DEFAULT_CHUNK,
+    }
+    raw = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()
+
+
+def manifest_version(manifest: dict) -> str:
+    """Version de l'index : change dès que la configuration ou un fichier indexé change."""
+    payload = {
+        "config": manifest.get("config", ""),
+        "files": {rel: f.get("sha256", "") for rel, f in manifest.get("files", {}).items()},
+    }
+    raw = json.dumps(payload, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:16]
+
+
+def _chunk_id(rel_path: str, page: int, index: int) -> str:
+    return f"{rel_path}#p{page}-{index}"
+
+
+def read_manifest(persist_dir: Path) -> dict:
+    """
+    Manifeste d'ingestion : empreinte de configuration + hash par fichier et par page,
+    avec les identifiants des chunks indexés pour chaque page.
+    """
+    try:
+        with open(persist_dir / MANIFEST_FILE, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"config": "", "files": {}}
+    manifest.setdefault("config", "")
+    manifest.setdefault("files", {})
+    return manifest
+
+
+def _write_manifest(persist_dir: Path, manifest: dict) -> None:
+    persist_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = persist_dir / (MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, persist_dir / MANIFEST_FILE)
+
+
+def _open_collection(persist_dir: Path, embeddings) -> Chroma:
+    return Chroma(
+        collection_name=COLLECTION_NAME,
+        embedding_function=embeddings,
+        persist_directory=str(persist_dir),
     )
+
+
+def _sync_file(
+    vectorstore: Chroma, raw_docs: List[Document], rel_path: str, entry: dict
+) -> Tuple[dict, List[Document], List[str]]:
+    """
+    Ré-ingère un fichier modifié : les chunks des pages disparues ou modifiées sont
+    supprimés, et seuls ceux des pages nouvelles ou modifiées sont renvoyés à embedder.
+    """
+    old_pages = entry.get("pages", {})
+    new_pages = {}
+    stale_ids = []
+    to_embed = []
+    seen = set()
+
+    for doc in raw_docs:
+        page_key = str(doc.metadata["page"])
+        seen.add(page_key)
+        page_hash = _text_sha256(doc.page_content)
+        old = old_pages.get(page_key)
+        if old and old.get("sha256") == page_hash:
+            new_pages[page_key] = old
+            continue
+        if old:
+            stale_ids.extend(old.get("chunks", []))
+        to_embed.append((page_key, page_hash, doc))
+
+    for page_key, old in old_pages.items():
+        if page_key not in seen:
+            stale_ids.extend(old.get("chunks", []))
+
+    if stale_ids:
+        vectorstore.delete(ids=stale_ids)
+
+    chunks, ids = [], []
+    for page_key, page_hash, doc in to_embed:
+        page_chunks = split_documents([doc])
+        page_ids = [_chunk_id(rel_path, doc.metadata["page"], i) for i in range(len(page_chunks))]
+        new_pages[page_key] = {"sha256": page_hash, "chunks": page_ids}
+        chunks.extend(page_chunks)
+        ids.extend(page_ids)
+
+    return {"sha256": entry.get("sha256", ""), "pages": new_pages}, chunks, ids
+
+
+def build_vectorstore(
+    api_key: str,
+    persist_directory: Optional[Path] = None,
+    force_rebuild: bool = False,
+) -> Chroma:
+    """
+    Charge le vectorstore persistant et le synchronise avec docs/ via le manifeste :
+    seuls les fichiers (et pages) nouveaux ou modifiés sont ré-embeddés.
+    Une reconstruction complète n'a lieu que si CHUNK_CONFIG ou le modèle changent.
+    api_key est gardé en paramètre pour la compatibilité mais non utilisé ici.
+    """
+    pdf_files = sorted(DOCS_DIR.rglob("*.pdf"))
+    if not pdf_files:
+        raise FileNotFoundError(f"Aucun PDF trouvé dans {DOCS_DIR}")
+
+    persist_dir = Path(persist_directory or INDEX_DIR)
+    manifest = read_manifest(persist_dir)
+    config = config_fingerprint()
+    rebuild = force_rebuild or manifest["config"] != config
+    if rebuild:
+        manifest = {"config": config, "files": {}}
+
+    current = {str(p.relative_to(DOCS_DIR)): p for p in pdf_files}
+    changed = False
+
+    # Fichiers nouveaux ou modifiés — extraits ensemble pour paralléliser, avant de charger
+    # le modèle d'embeddings : torch et ses threads n'arrivent qu'une fois les workers terminés
+    to_sync = []
+    for rel_path, pdf_path in current.items():
+        file_hash = _file_sha256(pdf_path)
+        if manifest["files"].get(rel_path, {}).get("sha256") != file_hash:
+            to_sync.append((rel_path, pdf_path, file_hash))
+    extracted = extract_pdfs([pdf_path for _, pdf_path, _ in to_sync])
+
+    embeddings = load_embeddings(EMBEDDING_MODEL, cache_path=persist_dir / EMBEDDING_CACHE_FILE)
+    vectorstore = _open_collection(persist_dir, embeddings)
+    if rebuild:
+        vectorstore.delete_collection()
+        vectorstore = _open_collection(persist_dir, embeddings)
+
+    # Fichiers supprimés du corpus
+    for rel_path in sorted(set(manifest["files"]) - set(current)):
+        entry = manifest["files"].pop(rel_path)
+        ids = [i for page in entry.get("pages", {}).values() for i in page.get("chunks", [])]
+        if ids:
+            vectorstore.delete(ids=ids)
+        changed = True
+
+    all_chunks, all_ids = [], []
+    for (rel_path, _, file_hash), raw_docs in zip(to_sync, extracted):
+        entry, chunks, ids = _sync_file(vectorstore, raw_docs, rel_path, manifest["files"].get(rel_path, {}))
+        entry["sha256"] = file_hash
+        manifest["files"][rel_path] = entry
+        all_chunks.extend(chunks)
+        all_ids.extend(ids)
+        changed = True
+
+    # Embeddings par lots, tous fichiers confondus
+    if all_chunks:
+        stats = add_documents_batched(vectorstore, all_chunks, all_ids)
+        print(f"Ingestion : {stats}")
+        manifest["last_ingestion"] = {
+            "chunks": stats.chunks,
+            "seconds": round(stats.seconds, 2),
+            "chunks_per_second": round(stats.chunks_per_second, 1),
+            "cache_hits": stats.cache_hits,
+            "peak_rss_mb": round(stats.peak_rss_mb, 1),
+        }
+
+    if not any(page["chunks"] for f in manifest["files"].values() for page in f["pages"].values()):
+        raise ValueError("Aucun texte extrait des PDFs.")
+
+    manifest["version"] = manifest_version(manifest)
+    if changed:
+        _write_manifest(persist_dir, manifest)
+    # Lu par rag.retriever pour invalider ses caches quand l'index change
+    vectorstore.index_version = manifest["version"]
+    precompute_fixed_contexts(vectorstore, persist_dir / FIXED_CONTEXTS_FILE)
     return vectorstore
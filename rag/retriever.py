@@ -1,12 +1,131 @@
 """
 UtopIA — Retriever RAG
 Fonctions de recherche sémantique utilisées par les nodes.
-Le vectorstore est passé en paramètre (construit par @st.cache_resource).
+Le vectorstore est passé en paramètre (instance partagée du processus, cf. rag.store).
 """
 
-from typing import List, Optional
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional
 from langchain_core.documents import Document
 
+from utils.tokens import count_tokens, fit
+
+QUERY_CACHE_SIZE = int(os.environ.get("UTOPIA_QUERY_CACHE_SIZE", "256"))
+RESULT_CACHE_SIZE = int(os.environ.get("UTOPIA_RESULT_CACHE_SIZE", "512"))
+RAG_TOKEN_BUDGET = int(os.environ.get("UTOPIA_RAG_TOKEN_BUDGET", "800"))
+MIN_PARTIAL_CHUNK = 80  # en deçà, un chunk qui ne tient pas entier est laissé de côté
+
+
+class LRUCache:
+    """Cache LRU borné et thread-safe, avec compteurs de hits/misses."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, value) -> None:
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
+
+
+# Requêtes RAG des nodes qui ne dépendent pas du patient : leur contexte est
+# calculé une fois par version de l'index (cf. precompute_fixed_contexts)
+FIXED_CONTEXTS = {
+    "modele_conceptuel": {
+        "query": "modele conceptuel ergotherapie evaluation besoins",
+        "k": 3, "category_filter": None,
+    },
+    "diagnostic": {
+        "query": "diagnostic evaluation besoins positionnement fauteuil roulant",
+        "k": 4, "category_filter": None,
+    },
+    "categorie_vph": {
+        "query": "indications categorie VPH fauteuil roulant prescription",
+        "k": 4, "category_filter": "reglementation",
+    },
+    "aides_techniques": {
+        "query": "fauteuil roulant indication remboursement prescription categorie",
+        "k": 6, "category_filter": None,
+    },
+    "premiere_question": {
+        "query": "evaluation capacites fonctionnelles fauteuil roulant propulsion transfert",
+        "k": 3, "category_filter": None,
+    },
+    "argumentaire": {
+        "query": "prise en charge remboursement prescription CPAM reforme VPH",
+        "k": 4, "category_filter": "reglementation",
+    },
+}
+
+_query_embeddings = LRUCache(QUERY_CACHE_SIZE)
+_search_results = LRUCache(RESULT_CACHE_SIZE)
+_fixed_contexts: Dict[str, Dict[str, str]] = {}  # version de l'index → {nom: contexte}
+
+
+def index_version(vectorstore) -> str:
+    """Version de l'index (posée par rag.ingest.build_vectorstore), à défaut l'identité de l'objet."""
+    return getattr(vectorstore, "index_version", None) or f"id-{id(vectorstore)}"
+
+
+def embed_query(query: str, vectorstore) -> List[float]:
+    """
+    Embedding d'une requête, servi depuis le cache LRU quand la même requête
+    a déjà été encodée par le même modèle (les nodes réutilisent des requêtes fixes).
+    """
+    embeddings = vectorstore.embeddings
+    key = (getattr(embeddings, "model_name", type(embeddings).__name__), query)
+    vector = _query_embeddings.get(key)
+    if vector is None:
+        vector = embeddings.embed_query(query)
+        _query_embeddings.put(key, vector)
+    return vector
+
+
+def query_cache_info() -> dict:
+    return _query_embeddings.info()
+
+
+def result_cache_info() -> dict:
+    return _search_results.info()
+
+
+def clear_result_cache() -> None:
+    _search_results.clear()
+
 
 def search(
     query: str,
@@ -14,37 +133,57 @@ def search(
     vectorstore=None,
     category_filter: Optional[str] = None,
 ) -> List[Document]:
-    """Recherche sémantique dans le vectorstore."""
+    """
+    Recherche sémantique dans le vectorstore.
+    Les résultats sont mis en cache par (requête, k, filtre, version de l'index) :
+    une reconstruction de l'index change la version et invalide le cache.
+    """
     if vectorstore is None:
         return []
+    key = (index_version(vectorstore), query, k, category_filter)
+    cached = _search_results.get(key)
+    if cached is not None:
+        return list(cached)
     try:
+        vector = embed_query(query, vectorstore)
         if category_filter:
-            results = vectorstore.similarity_search(
-                query, k=k, filter={"category": category_filter}
+            results = vectorstore.similarity_search_by_vector(
+                vector, k=k, filter={"category": category_filter}
             )
         else:
-            results = vectorstore.similarity_search(query, k=k)
-        return results
+            results = vectorstore.similarity_search_by_vector(vector, k=k)
     except Exception:
         return []
+    _search_results.put(key, list(results))
+    return results
 
 
-def format_context(docs: List[Document], max_chars: int = 3000) -> str:
-    """Formate les chunks récupérés en contexte lisible pour le LLM."""
+def format_context(docs: List[Document], max_tokens: int = RAG_TOKEN_BUDGET) -> str:
+    """
+    Formate les chunks récupérés en contexte lisible pour le LLM, dans la limite de
+    `max_tokens`. Les chunks arrivent par pertinence décroissante : les premiers sont
+    gardés entiers, le premier qui dépasse est réduit par phrases entières s'il reste la place.
+    """
     if not docs:
         return ""
+    separator = "\n\n---\n\n"
     parts = []
-    total = 0
+    remaining = max_tokens
     for doc in docs:
         source = doc.metadata.get("source", "?")
         page = doc.metadata.get("page", "?")
+        header = f"[{source} p.{page}]\n"
         content = doc.page_content.strip()
-        part = f"[{source} p.{page}]\n{content}"
-        if total + len(part) > max_chars:
-            break
-        parts.append(part)
-        total += len(part)
-    return "\n\n---\n\n".join(parts)
+        cost = count_tokens(header + content) + (count_tokens(separator) if parts else 0)
+        if cost <= remaining:
+            parts.append(header + content)
+            remaining -= cost
+            continue
+        room = remaining - count_tokens(header) - (count_tokens(separator) if parts else 0)
+        if room >= MIN_PARTIAL_CHUNK:
+            parts.append(header + fit(content, room))
+        break
+    return separator.join(parts)
 
 
 def get_vph_indications(profil_summary: str, vectorstore=None) -> str:
@@ -69,3 +208,56 @@ def get_cpam_context(type_vph: str, vectorstore=None) -> str:
         k=5, vectorstore=vectorstore, category_filter="reglementation"
     )
     return format_context(docs)
+
+
+def _compute_fixed_context(name: str, vectorstore) -> str:
+    spec = FIXED_CONTEXTS[name]
+    docs = search(
+        spec["query"], k=spec["k"], vectorstore=vectorstore,
+        category_filter=spec["category_filter"],
+    )
+    return format_context(docs)
+
+
+def precompute_fixed_contexts(vectorstore, cache_path: Optional[Path] = None) -> Dict[str, str]:
+    """
+    Calcule (ou recharge depuis `cache_path`) les contextes formatés de FIXED_CONTEXTS
+    pour la version courante de l'index. Appelé à la construction / au chargement de l'index.
+    """
+    version = index_version(vectorstore)
+    contexts = None
+    if cache_path is not None:
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                stored = json.load(f)
+            if (stored.get("version") == version and stored.get("queries") == FIXED_CONTEXTS
+                    and stored.get("token_budget") == RAG_TOKEN_BUDGET):
+                contexts = stored["contexts"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if contexts is None:
+        contexts = {name: _compute_fixed_context(name, vectorstore) for name in FIXED_CONTEXTS}
+        if cache_path is not None:
+            try:
+                with open(cache_path, "w", encoding="utf-8") as f:
+                    json.dump(
+                        {"version": version, "queries": FIXED_CONTEXTS,
+                         "token_budget": RAG_TOKEN_BUDGET, "contexts": contexts},
+                        f, ensure_ascii=False, indent=2,
+                    )
+            except OSError:
+                pass
+
+    _fixed_contexts[version] = contexts
+    return contexts
+
+
+def get_fixed_context(name: str, vectorstore=None) -> str:
+    """Contexte précalculé d'une requête fixe (calculé à la volée si absent)."""
+    if vectorstore is None:
+        return ""
+    contexts = _fixed_contexts.setdefault(index_version(vectorstore), {})
+    if name not in contexts:
+        contexts[name] = _compute_fixed_context(name, vectorstore)
+    return contexts[name]
@@ -0,0 +1,52 @@
+"""
+UtopIA — Vectorstore partagé
+Un seul index Chroma (et un seul modèle d'embeddings) par processus,
+partagé par toutes les sessions Streamlit et utilisable hors Streamlit.
+"""
+
+import threading
+
+_LOCK = threading.Lock()
+_STATE = {
+    "vectorstore": None,
+    "status": "idle",  # idle → loading → ready | error
+    "error": "",
+}
+
+
+def get_vectorstore():
+    """Retourne le vectorstore partagé, ou None s'il n'est pas encore chargé."""
+    return _STATE["vectorstore"]
+
+
+def get_status() -> str:
+    return _STATE["status"]
+
+
+def get_error() -> str:
+    return _STATE["error"]
+
+
+def init_vectorstore(api_key: str = "", force_rebuild: bool = False):
+    """
+    Charge (ou reconstruit) le vectorstore une seule fois pour tout le processus.
+    Les appels concurrents attendent le chargement en cours au lieu d'en lancer un second.
+    """
+    with _LOCK:
+        if _STATE["vectorstore"] is not None and not force_rebuild:
+            return _STATE["vectorstore"]
+        _STATE["status"] = "loading"
+        try:
+            from rag.ingest import build_vectorstore
+            vectorstore = build_vectorstore(api_key, force_rebuild=force_rebuild)
+        except Exception as e:
+            _STATE["status"] = "error"
+            _STATE["error"] = str(e)
+            raise
+        from rag.retriever import clear_result_cache
+        clear_result_cache()
+        _STATE["vectorstore"] = vectorstore
+        _STATE["status"] = "ready"
+        _STATE["error"] = ""
+        return vectorstore
+
@@ -0,0 +1,10 @@
+"""
+UtopIA — Configuration pytest
+Usage : python -m pytest -q tests
+"""
+
+import sys
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(BASE_DIR))
@@ -0,0 +1,70 @@
+"""
+UtopIA — Tests du découpage de l'historique d'entretien
+Comptage de tokens simulé (un mot = un token) : indépendant de tiktoken.
+"""
+
+import pytest
+
+from graph.nodes import chat_clinique
+from graph.nodes.chat_clinique import KEEP_RECENT_MESSAGES, _split_history
+
+BUDGET = 100
+
+
+@pytest.fixture(autouse=True)
+def word_tokens(monkeypatch):
+    monkeypatch.setattr(chat_clinique, "count_tokens", lambda text: len(text.split()))
+    monkeypatch.setattr(chat_clinique, "HISTORY_TOKEN_BUDGET", BUDGET)
+
+
+def _history(pairs: int, words: int = 8) -> list:
+    """`pairs` paires question / réponse de `words` mots (+ 2 pour « Rôle : »)."""
+    history = []
+    for i in range(pairs):
+        history.append({"role": "assistant", "content": " ".join(["question"] * words)})
+        history.append({"role": "user", "content": " ".join(["réponse"] * words)})
+    return history
+
+
+def _tokens(messages: list) -> int:
+    return sum(chat_clinique.count_tokens(chat_clinique._transcript([m])) for m in messages)
+
+
+def test_short_history_is_sent_as_is():
+    history = _history(5)  # 100 tokens
+    assert _split_history(history) == ([], history)
+
+
+@pytest.mark.parametrize("pairs", [6, 9, 14, 23, 40])
+def test_cut_on_pair_boundary_within_budget(pairs):
+    history = _history(pairs)
+    older, recent = _split_history(history)
+    assert older + recent == history
+    assert len(older) % 2 == 0 and older
+    assert recent[0]["role"] == "assistant"
+    assert _tokens(recent) <= BUDGET
+
+
+def test_pending_question_is_never_summarized():
+    history = _history(12) + [{"role": "assistant", "content": "question en attente"}]
+    older, recent = _split_history(history)
+    assert len(older) % 2 == 0
+    assert recent[-1]["content"] == "question en attente"
+    assert _tokens(recent) <= BUDGET
+
+
+def test_recent_messages_are_kept_even_over_budget():
+    history = _history(3) + _history(2, words=60)
+    older, recent = _split_history(history)
+    assert recent[-KEEP_RECENT_MESSAGES:] == history[-KEEP_RECENT_MESSAGES:]
+    assert len(older) == len(history) - KEEP_RECENT_MESSAGES
+
+
+def test_summarized_slice_changes_rarely():
+    # La tranche résumée (mémoïsée) ne change qu'au franchissement d'un demi-budget d'échanges,
+    # pas à chaque tour : 34 nouvelles paires de 20 tokens → au plus 680 / 50 coupures
+    cuts = [len(_split_history(_history(n))[0]) for n in range(6, 40)]
+    assert cuts == sorted(cuts)
+    changes = sum(1 for before, after in zip(cuts, cuts[1:]) if before != after)
+    assert changes <= (40 - 6) * 20 // (BUDGET // 2)
+    assert changes < len(cuts) - 1
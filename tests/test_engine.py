@@ -0,0 +1,157 @@
+"""
+UtopIA — Tests du moteur de graphe et de l'orchestration de la préconisation
+Les nodes sont remplacés par des fonctions locales : aucun appel LLM.
+"""
+
+import pytest
+
+from graph import preconisation
+from graph.engine import Graph, Node
+from graph.state import PatientState
+
+
+def _node(calls, name, inputs, outputs, result):
+    def run(patient, api_key, vectorstore, refresh=False):
+        calls.append((name, refresh))
+        return result(patient)
+    return Node(name, run, inputs=inputs, outputs=outputs)
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def graph(calls):
+    return Graph([
+        _node(calls, "aval", ("diagnostic_ergo",), ("propositions_at",),
+              lambda p: {"propositions_at": "AT pour " + p.diagnostic_ergo}),
+        _node(calls, "amont", ("diagnostic",), ("diagnostic_ergo",),
+              lambda p: {"diagnostic_ergo": "diag " + p.diagnostic, "brouillon": "notes"}),
+    ])
+
+
+def _names(calls):
+    return [name for name, _ in calls]
+
+
+def test_run_in_dependency_order_and_keep_artifacts(graph, calls):
+    patient = PatientState(diagnostic="SEP")
+    report = graph.run(patient, "cle")
+    assert _names(calls) == ["amont", "aval"]
+    assert patient.propositions_at == "AT pour diag SEP"
+    assert report.artifacts == {"amont": {"brouillon": "notes"}}
+
+
+def test_unchanged_inputs_are_skipped(graph, calls):
+    patient, cache = PatientState(diagnostic="SEP"), {}
+    graph.run(patient, "cle", cache=cache)
+    calls.clear()
+    report = graph.run(patient, "cle", cache=cache)
+    assert calls == []
+    assert report.skipped == ["amont", "aval"]
+
+
+def test_changed_input_reruns_downstream(graph, calls):
+    patient, cache = PatientState(diagnostic="SEP"), {}
+    graph.run(patient, "cle", cache=cache)
+    calls.clear()
+    patient.diagnostic = "AVC"
+    graph.run(patient, "cle", cache=cache)
+    assert _names(calls) == ["amont", "aval"]
+    assert patient.propositions_at == "AT pour diag AVC"
+
+
+def test_missing_output_reruns_node(graph, calls):
+    patient, cache = PatientState(diagnostic="SEP"), {}
+    graph.run(patient, "cle", cache=cache)
+    calls.clear()
+    patient.propositions_at = ""
+    graph.run(patient, "cle", cache=cache)
+    assert _names(calls) == ["aval"]
+
+
+def test_force_and_refresh_rerun_everything(graph, calls):
+    patient, cache = PatientState(diagnostic="SEP"), {}
+    graph.run(patient, "cle", cache=cache)
+    calls.clear()
+    graph.run(patient, "cle", cache=cache, force=True)
+    assert calls == [("amont", False), ("aval", False)]
+    calls.clear()
+    graph.run(patient, "cle", cache=cache, refresh=True)
+    assert calls == [("amont", True), ("aval", True)]
+
+
+def test_excluded_node_does_not_block_downstream(graph, calls):
+    patient = PatientState(diagnostic="SEP", diagnostic_ergo="saisi à la main")
+    graph.run(patient, "cle", exclude=["amont"])
+    assert _names(calls) == ["aval"]
+    assert patient.propositions_at == "AT pour saisi à la main"
+
+
+def test_invalid_graphs_are_rejected(calls):
+    amont = _node(calls, "amont", ("diagnostic",), ("diagnostic_ergo",), dict)
+    with pytest.raises(ValueError):
+        Graph([amont, _node(calls, "amont", (), ("propositions_at",), dict)])
+    with pytest.raises(ValueError):
+        Graph([amont, _node(calls, "autre", (), ("diagnostic_ergo",), dict)])
+    with pytest.raises(ValueError):
+        Graph([
+            _node(calls, "a", ("diagnostic_ergo",), ("propositions_at",), dict),
+            _node(calls, "b", ("propositions_at",), ("diagnostic_ergo",), dict),
+        ])
+
+
+@pytest.fixture
+def pipeline(monkeypatch, calls):
+    """PRECONISATION_GRAPH avec des nodes sans LLM ; la catégorie détectée est toujours FRMC."""
+    results = {
+        "modele_conceptuel": lambda p: {"modele_conceptuel_choisi": "MCREO", "justification_modele": "j"},
+        "diagnostic": lambda p: {"diagnostic_ergo": "diag " + p.diagnostic},
+        "categorie_vph": lambda p: {"categorie_vph_recommandee": "FRMC"},
+        "aides_techniques": lambda p: {"propositions_at": "AT pour " + p.categorie_vph_recommandee},
+    }
+    for name, node in preconisation.PRECONISATION_GRAPH.nodes.items():
+        stub = _node(calls, name, node.inputs, node.outputs, results[name])
+        monkeypatch.setattr(node, "run", stub.run)
+    return preconisation.run_preconisation
+
+
+def test_manual_category_is_kept_and_reruns_at_search(pipeline, calls):
+    patient, cache = PatientState(nom="X", diagnostic="SEP"), {}
+    pipeline(patient, "cle", cache=cache)
+    assert patient.propositions_at == "AT pour FRMC"
+    calls.clear()
+
+    patient.categorie_vph_recommandee = "FRE-B"
+    pipeline(patient, "cle", cache=cache)
+    assert _names(calls) == ["aides_techniques"]
+    assert patient.propositions_at == "AT pour FRE-B"
+    calls.clear()
+
+    # refresh régénère tout sauf le choix manuel
+    pipeline(patient, "cle", cache=cache, refresh=True)
+    assert "categorie_vph" not in _names(calls)
+    assert patient.categorie_vph_recommandee == "FRE-B"
+
+
+def test_detected_category_follows_its_inputs(pipeline, calls):
+    patient, cache = PatientState(nom="X", diagnostic="SEP"), {}
+    pipeline(patient, "cle", cache=cache)
+    calls.clear()
+    patient.diagnostic = "AVC"
+    pipeline(patient, "cle", cache=cache)
+    assert _names(calls) == ["modele_conceptuel", "diagnostic", "categorie_vph", "aides_techniques"]
+
+
+def test_cleared_category_is_detected_again(pipeline, calls):
+    patient, cache = PatientState(nom="X", diagnostic="SEP"), {}
+    pipeline(patient, "cle", cache=cache)
+    patient.categorie_vph_recommandee = "FRE-B"
+    pipeline(patient, "cle", cache=cache)
+    calls.clear()
+    patient.categorie_vph_recommandee = ""
+    pipeline(patient, "cle", cache=cache)
+    assert _names(calls) == ["categorie_vph", "aides_techniques"]
+    assert patient.propositions_at == "AT pour FRMC"
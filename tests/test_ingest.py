@@ -0,0 +1,131 @@
+"""
+UtopIA — Tests de la synchronisation incrémentale de l'index (manifeste)
+Vraies extractions PDF (PyMuPDF) ; le vectorstore et le modèle d'embeddings sont
+remplacés par un magasin en mémoire. Nécessite les dépendances de rag/ (requirements.txt).
+"""
+
+import pytest
+
+fitz = pytest.importorskip("fitz")
+pytest.importorskip("langchain_huggingface")
+
+from rag import ingest  # noqa: E402
+from rag.embeddings import EmbeddingStats  # noqa: E402
+
+
+class MemoryStore:
+    """Collection en mémoire : identifiant de chunk → texte."""
+
+    def __init__(self):
+        self.chunks = {}
+        self.embedded = []
+
+    def delete(self, ids):
+        for chunk_id in ids:
+            self.chunks.pop(chunk_id, None)
+
+    def delete_collection(self):
+        self.chunks.clear()
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    store = MemoryStore()
+
+    def add_documents_batched(vectorstore, docs, ids):
+        vectorstore.embedded.extend(ids)
+        vectorstore.chunks.update(zip(ids, (doc.page_content for doc in docs)))
+        return EmbeddingStats(chunks=len(docs))
+
+    monkeypatch.setattr(ingest, "DOCS_DIR", tmp_path / "docs")
+    monkeypatch.setattr(ingest, "INGEST_WORKERS", 1)
+    monkeypatch.setattr(ingest, "load_embeddings", lambda *args, **kwargs: None)
+    monkeypatch.setattr(ingest, "_open_collection", lambda persist_dir, embeddings: store)
+    monkeypatch.setattr(ingest, "add_documents_batched", add_documents_batched)
+    monkeypatch.setattr(ingest, "precompute_fixed_contexts", lambda vectorstore, path: None)
+    return store
+
+
+def _write_pdf(path, pages):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    pdf = fitz.open()
+    for text in pages:
+        pdf.new_page().insert_text((72, 72), text)
+    pdf.save(str(path))
+    pdf.close()
+
+
+def _page(label):
+    return f"Page {label} : indications du fauteuil roulant manuel et électrique."
+
+
+def _build(tmp_path, store, **kwargs):
+    store.embedded.clear()
+    ingest.build_vectorstore("", persist_directory=tmp_path / "index", **kwargs)
+    return ingest.read_manifest(tmp_path / "index")
+
+
+def test_first_build_indexes_every_page(tmp_path, store):
+    docs = tmp_path / "docs"
+    _write_pdf(docs / "reglementation" / "a.pdf", [_page("A1"), _page("A2")])
+    _write_pdf(docs / "categories-vph" / "b.pdf", [_page("B1")])
+
+    manifest = _build(tmp_path, store)
+
+    assert set(manifest["files"]) == {"reglementation/a.pdf", "categories-vph/b.pdf"}
+    assert set(manifest["files"]["reglementation/a.pdf"]["pages"]) == {"1", "2"}
+    indexed = [i for f in manifest["files"].values() for p in f["pages"].values() for i in p["chunks"]]
+    assert sorted(indexed) == sorted(store.chunks) == sorted(store.embedded)
+    assert manifest["config"] == ingest.config_fingerprint()
+
+
+def test_unchanged_corpus_embeds_nothing(tmp_path, store):
+    _write_pdf(tmp_path / "docs" / "reglementation" / "a.pdf", [_page("A1")])
+    first = _build(tmp_path, store)
+    second = _build(tmp_path, store)
+    assert store.embedded == []
+    assert second["version"] == first["version"]
+
+
+def test_modified_page_only_is_reembedded(tmp_path, store):
+    path = tmp_path / "docs" / "reglementation" / "a.pdf"
+    _write_pdf(path, [_page("A1"), _page("A2"), _page("A3")])
+    first = _build(tmp_path, store)
+
+    _write_pdf(path, [_page("A1"), _page("A2 modifiée")])
+    second = _build(tmp_path, store)
+
+    pages = second["files"]["reglementation/a.pdf"]["pages"]
+    assert set(pages) == {"1", "2"}
+    assert store.embedded == pages["2"]["chunks"]
+    assert pages["1"] == first["files"]["reglementation/a.pdf"]["pages"]["1"]
+    assert not set(first["files"]["reglementation/a.pdf"]["pages"]["3"]["chunks"]) & set(store.chunks)
+    assert "A2 modifiée" in store.chunks[pages["2"]["chunks"][0]]
+    assert second["version"] != first["version"]
+
+
+def test_added_and_deleted_files(tmp_path, store):
+    docs = tmp_path / "docs"
+    _write_pdf(docs / "reglementation" / "a.pdf", [_page("A1")])
+    _write_pdf(docs / "reglementation" / "b.pdf", [_page("B1")])
+    first = _build(tmp_path, store)
+
+    (docs / "reglementation" / "b.pdf").unlink()
+    _write_pdf(docs / "argumentaires" / "c.pdf", [_page("C1")])
+    second = _build(tmp_path, store)
+
+    assert set(second["files"]) == {"reglementation/a.pdf", "argumentaires/c.pdf"}
+    assert store.embedded == second["files"]["argumentaires/c.pdf"]["pages"]["1"]["chunks"]
+    assert not set(first["files"]["reglementation/b.pdf"]["pages"]["1"]["chunks"]) & set(store.chunks)
+
+
+def test_config_change_rebuilds_everything(tmp_path, store, monkeypatch):
+    _write_pdf(tmp_path / "docs" / "reglementation" / "a.pdf", [_page("A1")])
+    _build(tmp_path, store)
+    monkeypatch.setattr(ingest, "DEFAULT_CHUNK", {"chunk_size": 300, "chunk_overlap": 60})
+    manifest = _build(tmp_path, store)
+    assert store.embedded and sorted(store.embedded) == sorted(store.chunks)
+    assert manifest["config"] == ingest.config_fingerprint()
+
+    _build(tmp_path, store, force_rebuild=True)
+    assert sorted(store.embedded) == sorted(store.chunks)
@@ -0,0 +1,174 @@
+"""
+UtopIA — Tests de l'ordonnanceur des appels LLM
+Horloge simulée : aucune attente réelle, aucun appel API.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import anthropic
+import httpx
+import pytest
+
+from graph import scheduler
+from graph.scheduler import BULK, INTERACTIVE, NORMAL, TokenBucket
+
+REQUEST = {"messages": [{"role": "user", "content": "Bonjour"}], "max_tokens": 10}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Remplace time dans le module : monotonic() contrôlé, sleep() enregistré et instantané."""
+    fake = SimpleNamespace(now=1000.0, sleeps=[])
+    fake.monotonic = lambda: fake.now
+    fake.sleep = fake.sleeps.append
+    monkeypatch.setattr(scheduler, "time", fake)
+    return fake
+
+
+def _status_error(status: int, headers: dict = None) -> anthropic.APIStatusError:
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    error_class = anthropic.RateLimitError if status == 429 else anthropic.APIStatusError
+    return error_class("erreur", response=response, body=None)
+
+
+def _failing(*errors, result="ok"):
+    """call() qui lève successivement `errors` puis retourne `result`."""
+    pending = list(errors)
+    attempts = []
+
+    def call():
+        attempts.append(1)
+        if pending:
+            raise pending.pop(0)
+        return result
+    call.attempts = attempts
+    return call
+
+
+def test_bucket_serves_priority_then_arrival(clock):
+    bucket = TokenBucket(600)
+    bulk = bucket.enqueue(BULK)
+    normal = bucket.enqueue(NORMAL)
+    interactive = bucket.enqueue(INTERACTIVE)
+    # Jetons disponibles, mais seul le premier de la file peut se servir
+    assert bucket.try_acquire(bulk, 10) > 0
+    assert bucket.try_acquire(normal, 10) > 0
+    assert bucket.try_acquire(interactive, 10) == 0
+    assert bucket.try_acquire(bulk, 10) > 0
+    assert bucket.try_acquire(normal, 10) == 0
+    assert bucket.try_acquire(bulk, 10) == 0
+
+
+def test_bucket_waits_for_refill(clock):
+    bucket = TokenBucket(600)  # 10 tokens / s
+    assert bucket.try_acquire(bucket.enqueue(NORMAL), 600) == 0
+    entry = bucket.enqueue(NORMAL)
+    assert bucket.try_acquire(entry, 300) == pytest.approx(30)
+    clock.now += 30
+    assert bucket.try_acquire(entry, 300) == 0
+
+
+def test_oversized_request_is_capped_to_capacity(clock):
+    bucket = TokenBucket(600)
+    assert bucket.try_acquire(bucket.enqueue(NORMAL), 10_000) == 0
+    assert bucket.available == 0
+
+
+def test_settle_and_drain(clock):
+    bucket = TokenBucket(600)
+    bucket.try_acquire(bucket.enqueue(NORMAL), 500)
+    bucket.settle(500, 100)
+    assert bucket.available == 500
+    bucket.settle(0, 800)  # usage supérieur à la réservation : dette
+    assert bucket.available == -300
+    bucket.settle(900, 0)  # réservation plafonnée à la capacité, comme dans try_acquire
+    assert bucket.available == 300
+    bucket.drain()
+    assert bucket.available == 0
+
+
+def test_leave_unblocks_next_in_line(clock):
+    bucket = TokenBucket(600)
+    first, second = bucket.enqueue(NORMAL), bucket.enqueue(NORMAL)
+    assert bucket.try_acquire(second, 10) > 0
+    bucket.leave(first)
+    assert bucket.try_acquire(second, 10) == 0
+
+
+def test_retry_delay(monkeypatch):
+    monkeypatch.setattr(scheduler, "BACKOFF_BASE", 1.0)
+    monkeypatch.setattr(scheduler, "BACKOFF_MAX", 30.0)
+    assert scheduler._retry_delay(_status_error(400), 0) is None
+    assert scheduler._retry_delay(ValueError("bug"), 0) is None
+    assert scheduler._retry_delay(_status_error(429, {"retry-after": "7"}), 0) == 7
+    assert scheduler._retry_delay(_status_error(529, {"retry-after": "600"}), 0) == 30
+    for attempt in range(8):
+        delay = scheduler._retry_delay(_status_error(529), attempt)
+        assert 0 <= delay <= min(30, 2 ** attempt)
+    connection = anthropic.APIConnectionError(request=httpx.Request("POST", "https://api.anthropic.com"))
+    assert 0 <= scheduler._retry_delay(connection, 2) <= 4
+
+
+def test_priority_override():
+    assert scheduler._priority("generate_first_question") == INTERACTIVE
+    with scheduler.priority(BULK):
+        assert scheduler._priority("generate_first_question") == BULK
+    assert scheduler._priority("write_argumentaire") == BULK
+    assert scheduler._priority("node_inconnu") == NORMAL
+
+
+def test_submit_retries_transient_errors(monkeypatch, clock):
+    monkeypatch.setattr(scheduler, "TOKENS_PER_MINUTE", 0)
+    call = _failing(_status_error(529), _status_error(429, {"retry-after": "2"}))
+    retries = []
+    assert scheduler.submit("cle", "node", REQUEST, call, on_retry=lambda: retries.append(1)) == "ok"
+    assert len(call.attempts) == 3
+    assert len(retries) == 2
+    assert clock.sleeps[1] == 2
+
+
+def test_submit_gives_up(monkeypatch, clock):
+    monkeypatch.setattr(scheduler, "TOKENS_PER_MINUTE", 0)
+    monkeypatch.setattr(scheduler, "MAX_RETRIES", 2)
+    call = _failing(*[_status_error(529)] * 5)
+    with pytest.raises(anthropic.APIStatusError):
+        scheduler.submit("cle", "node", REQUEST, call)
+    assert len(call.attempts) == 3
+
+    call = _failing(_status_error(400))
+    with pytest.raises(anthropic.APIStatusError):
+        scheduler.submit("cle", "node", REQUEST, call)
+    assert len(call.attempts) == 1
+
+
+def test_submit_settles_reservation(monkeypatch, clock):
+    monkeypatch.setattr(scheduler, "TOKENS_PER_MINUTE", 6000)
+    monkeypatch.setattr(scheduler, "_BUCKETS", {})
+    usage = SimpleNamespace(input_tokens=40, cache_creation_input_tokens=None, output_tokens=8)
+    scheduler.submit("cle", "node", REQUEST, lambda: SimpleNamespace(usage=usage))
+    bucket = scheduler._BUCKETS["cle"]
+    assert bucket.available == 6000 - 48
+
+    # Échec définitif : la réservation est rendue, un 429 vide le seau
+    with pytest.raises(anthropic.APIStatusError):
+        scheduler.submit("cle", "node", REQUEST, _failing(_status_error(400)))
+    assert bucket.available == 6000 - 48
+    monkeypatch.setattr(scheduler, "MAX_RETRIES", 0)
+    with pytest.raises(anthropic.RateLimitError):
+        scheduler.submit("cle", "node", REQUEST, _failing(_status_error(429)))
+    assert bucket.available == 0
+
+
+def test_asubmit_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(scheduler, "TOKENS_PER_MINUTE", 0)
+    monkeypatch.setattr(scheduler, "BACKOFF_BASE", 0.0)
+    errors = [_status_error(503)]
+
+    async def call():
+        if errors:
+            raise errors.pop()
+        return "ok"
+    assert asyncio.run(scheduler.asubmit("cle", "node", REQUEST, call)) == "ok"
+    assert errors == []
@@ -0,0 +1,105 @@
+"""
+UtopIA — Tests du comptage et de la réduction de texte à un budget de tokens
+Valables avec tiktoken comme avec le repli ~4 caractères par token.
+"""
+
+import pytest
+
+from utils.tokens import ELLIPSIS, count_tokens, fit, fit_lines, request_tokens
+
+SENTENCES = [
+    "Le patient présente une sclérose en plaques évoluant depuis dix ans.",
+    "Il vit seul dans un appartement au deuxième étage avec ascenseur.",
+    "Les transferts lit fauteuil se font avec une aide humaine partielle.",
+    "Il souhaite reprendre ses activités de loisirs en extérieur le week-end.",
+    "La fatigabilité limite la propulsion manuelle au-delà de cent mètres.",
+] * 6
+TEXT = " ".join(SENTENCES)
+
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert 0 < count_tokens("fauteuil") < count_tokens(TEXT)
+
+
+def test_request_tokens_covers_system_messages_and_tools():
+    base = {"system": "Tu es UtopIA.", "messages": [{"role": "user", "content": "Bonjour"}]}
+    with_tools = dict(base, tools=[{"name": "reponse", "input_schema": {"type": "object"}}])
+    assert 0 < request_tokens(base) < request_tokens(with_tools)
+
+
+def test_fit_keeps_short_text():
+    assert fit("Texte court.", 50) == "Texte court."
+
+
+@pytest.mark.parametrize("budget", [40, 60, 150])
+def test_fit_cuts_whole_sentences_within_budget(budget):
+    result = fit(TEXT, budget)
+    assert count_tokens(result) <= budget
+    assert result.endswith(ELLIPSIS)
+    kept = result[:-len(ELLIPSIS)]
+    assert TEXT.startswith(kept)
+    assert kept.endswith(".")
+
+
+def test_fit_cuts_by_words_when_no_sentence_fits():
+    budget = count_tokens(SENTENCES[0]) - 5
+    result = fit(TEXT, budget)
+    assert count_tokens(result) <= budget
+    kept = result[:-len(ELLIPSIS)]
+    assert SENTENCES[0].startswith(kept) and kept and not kept.endswith(".")
+    assert SENTENCES[0].startswith(kept + " ")
+
+
+def test_fit_prefers_sentences_sharing_the_focus():
+    text = " ".join(SENTENCES[:4] + ["Le domicile comporte trois marches sans rampe d'accès."])
+    result = fit(text, count_tokens(SENTENCES[4]) + 10, focus="accessibilité du domicile, marches")
+    assert "trois marches" in result
+    assert count_tokens(result) <= count_tokens(SENTENCES[4]) + 10
+
+
+def test_fit_keeps_paragraph_order():
+    text = "Premier paragraphe sur la posture.\nSecond paragraphe sur les transferts.\n" + TEXT
+    result = fit(text, 40, focus="transferts posture")
+    assert result.index("posture") < result.index("transferts")
+
+
+@pytest.mark.parametrize("text", ["x" * 2000, "é" * 800, "mot" + "-" * 1500])
+def test_fit_cuts_text_without_sentences_or_spaces(text):
+    result = fit(text, 30)
+    assert result and result.endswith(ELLIPSIS)
+    assert count_tokens(result) <= 30
+    assert text.startswith(result[:-len(ELLIPSIS)])
+
+
+def test_fit_returns_nothing_below_the_ellipsis():
+    assert fit(TEXT, 1) == ""
+
+
+def test_fit_lines_keeps_every_label_within_budget():
+    lines = [
+        "Nom : Martin",
+        "Diagnostic : " + TEXT,
+        "Lieu de vie : " + " ".join(SENTENCES[:10]),
+        "Poids : 72 kg",
+    ]
+    budget = 200
+    result = fit_lines(lines, budget)
+    assert len(result) == len(lines)
+    assert result[0] == lines[0] and result[3] == lines[3]
+    for before, after in zip(lines, result):
+        assert after.partition(" : ")[0] == before.partition(" : ")[0]
+    assert sum(count_tokens(line) + 1 for line in result) <= budget
+
+
+def test_fit_lines_never_shrinks_below_min_line():
+    lines = ["Diagnostic : " + TEXT, "Activités : " + TEXT]
+    result = fit_lines(lines, 10, min_line=40)
+    for line in result:
+        assert count_tokens(line) >= 30
+        assert count_tokens(line) <= 40 + count_tokens("Diagnostic : ")
+
+
+def test_fit_lines_leaves_fitting_lines_untouched():
+    lines = ["Nom : Martin", "Diagnostic : SEP"]
+    assert fit_lines(lines, 100) == lines
@@ -0,0 +1,141 @@
+"""
+UtopIA — Comptage de tokens
+Estimation locale avec tiktoken (encodage cl100k_base) : le tokenizer de Claude
+diffère légèrement, mais l'ordre de grandeur suffit pour tenir des budgets de prompt.
+Sans accès au fichier d'encodage (premier lancement hors ligne), repli sur ~4 caractères par token.
+fit / fit_lines réduisent un texte à un budget de tokens sans le couper au milieu d'une phrase.
+"""
+
+import json
+import re
+import threading
+import unicodedata
+from typing import List
+
+_LOCK = threading.Lock()
+_ENCODING = {"loaded": False, "value": None}
+
+
+def _encoding():
+    with _LOCK:
+        if not _ENCODING["loaded"]:
+            try:
+                import tiktoken
+                _ENCODING["value"] = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                _ENCODING["value"] = None
+            _ENCODING["loaded"] = True
+        return _ENCODING["value"]
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def request_tokens(request: dict) -> int:
+    """Tokens d'entrée estimés d'une requête messages (system, messages, outils)."""
+    payload = {name: request.get(name) for name in ("system", "messages", "tools")}
+    return count_tokens(json.dumps(payload, ensure_ascii=False))
+
+
+ELLIPSIS = " […]"
+_SENTENCE_END = re.compile(r"(?<=[.!?;])\s+")
+
+
+def _stems(text: str) -> set:
+    # Minuscules sans accents, mots tronqués à 6 lettres : « transferts » ~ « transfert »
+    plain = unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode()
+    return {word[:6] for word in re.findall(r"[a-z]{4,}", plain)}
+
+
+def _cut_tokens(text: str, budget: int) -> str:
+    # Dernier recours (texte sans espace, premier mot plus long que le budget) : coupe au token
+    room = budget - count_tokens(ELLIPSIS)
+    if room <= 0:
+        return ""
+    encoding = _encoding()
+    if encoding is None:
+        cut = text[:(room - 1) * 4]
+    else:
+        tokens = encoding.encode(text, disallowed_special=())[:room]
+        cut = encoding.decode(tokens).rstrip("\ufffd")  # pas de caractère multi-octets tronqué
+    while cut and count_tokens(cut + ELLIPSIS) > budget:
+        cut = cut[:-1]
+    return cut + ELLIPSIS if cut else ""
+
+
+def _cut_words(text: str, budget: int) -> str:
+    words = text.split()
+    kept: List[str] = []
+    for word in words:
+        if count_tokens(" ".join(kept + [word]) + ELLIPSIS) > budget:
+            break
+        kept.append(word)
+    return " ".join(kept) + ELLIPSIS if kept else _cut_tokens(text, budget)
+
+
+def fit(text: str, budget: int, focus: str = "") -> str:
+    """
+    Réduit `text` à `budget` tokens par phrases entières.
+    Avec `focus`, les phrases qui partagent le plus de mots avec lui sont gardées en priorité ;
+    l'ordre d'origine est conservé et la coupe est signalée par « […] ».
+    """
+    if count_tokens(text) <= budget:
+        return text
+    sentences = [
+        (p, i, sentence)
+        for p, paragraph in enumerate(text.split("\n"))
+        for i, sentence in enumerate(_SENTENCE_END.split(paragraph.strip()))
+        if sentence
+    ]
+    focus_stems = _stems(focus)
+    ranked = sorted(
+        sentences,
+        key=lambda s: (-len(_stems(s[2]) & focus_stems), s[0], s[1]),
+    ) if focus_stems else sentences
+
+    remaining = budget - count_tokens(ELLIPSIS)
+    kept = set()
+    for sentence in ranked:
+        size = count_tokens(sentence[2]) + 1
+        if size <= remaining:
+            kept.add(sentence)
+            remaining -= size
+        elif not focus_stems:
+            break  # sans focus : on garde le début du texte
+    if not kept:
+        return _cut_words(text, budget)
+
+    paragraphs: dict = {}
+    for p, i, sentence in sentences:
+        if (p, i, sentence) in kept:
+            paragraphs.setdefault(p, []).append(sentence)
+    return "\n".join(" ".join(paragraphs[p]) for p in sorted(paragraphs)) + ELLIPSIS
+
+
+def fit_lines(lines: List[str], budget: int, focus: str = "", min_line: int = 30) -> List[str]:
+    """
+    Tient une liste de lignes (« Libellé : valeur ») dans `budget` tokens sans en supprimer :
+    les plus longues sont réduites en premier, jusqu'à `min_line` tokens chacune.
+    """
+    sizes = [count_tokens(line) + 1 for line in lines]
+    overflow = sum(sizes) - budget
+    lines = list(lines)
+    for i in sorted(range(len(lines)), key=lambda i: -sizes[i]):
+        if overflow <= 0:
+            break
+        target = max(sizes[i] - 1 - overflow, min_line)
+        if target >= sizes[i] - 1:
+            continue
+        label, sep, value = lines[i].partition(" : ")
+        if sep and value:
+            lines[i] = label + sep + fit(value, max(target - count_tokens(label + sep), min_line), focus)
+        else:
+            lines[i] = fit(lines[i], target, focus)
+        overflow -= sizes[i] - 1 - count_tokens(lines[i])
+    return lines